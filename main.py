@@ -1,4 +1,4 @@
-from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult
+from astrbot.api.event import filter, AstrMessageEvent, MessageEventResult, MessageChain
 from astrbot.api.star import Context, Star, register
 from astrbot.api import logger
 from astrbot.core.config.astrbot_config import AstrBotConfig
@@ -9,12 +9,21 @@ from astrbot.core.utils.session_waiter import (
 )
 import asyncio
 import aiohttp
+import contextlib
+import copy
 import json
 import re
 import time
-from typing import Optional, Dict, Any
-from datetime import datetime
+from typing import Optional, Dict, Any, AsyncIterator
+from abc import ABC, abstractmethod
+from collections import deque, defaultdict
+from contextvars import ContextVar
+from datetime import datetime, timedelta
 import os
+import gzip
+import hashlib
+import socket
+import uuid
 import aiosqlite
 
 
@@ -34,9 +43,56 @@ class Main(Star):
         # 获取配置参数
         self.api_base_url = self.plugin_config.get("api_base_url", "http://api:8000") if self.plugin_config else "http://api:8000"
         self.timeout = self.plugin_config.get("timeout", 30) if self.plugin_config else 30
-        self.query_timeout = self.plugin_config.get("query_timeout", 600) if self.plugin_config else 600  # 查询超时设为10分钟
+        self.query_timeout = self.plugin_config.get("query_timeout", 600) if self.plugin_config else 600  # 单个问题的总时间预算
+        self.analysis_timeout = self.plugin_config.get("analysis_timeout", 1800) if self.plugin_config else 1800  # 单次仓库分析的总时间预算
         self.poll_interval = self.plugin_config.get("poll_interval", 5) if self.plugin_config else 5
         
+        # 任务记录保留策略
+        self.task_retention_days = self.plugin_config.get("task_retention_days", 7) if self.plugin_config else 7
+        self.task_retention_archive = self.plugin_config.get("task_retention_archive", True) if self.plugin_config else True
+        self.task_archive_retention_days = self.plugin_config.get("task_archive_retention_days", 90) if self.plugin_config else 90
+        self.retention_check_interval = self.plugin_config.get("retention_check_interval", 3600) if self.plugin_config else 3600
+        self.status_page_size = self.plugin_config.get("status_page_size", 5) if self.plugin_config else 5
+        
+        # 共享状态与缓存配置
+        self.state_backend = self.plugin_config.get("state_backend", "sqlite") if self.plugin_config else "sqlite"
+        self.state_backend_url = self.plugin_config.get("state_backend_url", "redis://localhost:6379/0") if self.plugin_config else "redis://localhost:6379/0"
+        self.instance_id = (self.plugin_config.get("instance_id", "") if self.plugin_config else "") or f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:6]}"
+        self.lease_ttl = self.plugin_config.get("lease_ttl", 60) if self.plugin_config else 60
+        self.analysis_cache_ttl = self.plugin_config.get("analysis_cache_ttl", 86400) if self.plugin_config else 86400
+        self.answer_cache_ttl = self.plugin_config.get("answer_cache_ttl", 86400) if self.plugin_config else 86400
+        
+        # 请求追踪配置
+        self.trace_buffer_size = self.plugin_config.get("trace_buffer_size", 200) if self.plugin_config else 200
+        self.trace_slow_threshold = self.plugin_config.get("trace_slow_threshold", 60) if self.plugin_config else 60
+        self.trace_slow_threshold_analysis = self.plugin_config.get("trace_slow_threshold_analysis", 900) if self.plugin_config else 900
+        
+        # 答案生成模式：auto 按延迟和错误率自动选择，service/plugin 强制使用
+        self.generation_mode = self.plugin_config.get("generation_mode", "auto") if self.plugin_config else "auto"
+        
+        # 分析完成后预取常见问题的答案
+        self.prefetch_enabled = self.plugin_config.get("prefetch_enabled", False) if self.plugin_config else False
+        self.prefetch_questions = self.plugin_config.get("prefetch_questions", DEFAULT_PREFETCH_QUESTIONS) if self.plugin_config else DEFAULT_PREFETCH_QUESTIONS
+        self.prefetch_max_questions = self.plugin_config.get("prefetch_max_questions", 4) if self.plugin_config else 4
+        self.prefetch_budget_seconds = self.plugin_config.get("prefetch_budget_seconds", 300) if self.plugin_config else 300
+        self.prefetch_concurrency = self.plugin_config.get("prefetch_concurrency", 1) if self.plugin_config else 1
+        
+        # 批量分析配置
+        self.batch_concurrency = self.plugin_config.get("batch_concurrency", 3) if self.plugin_config else 3
+        self.batch_max_repos = self.plugin_config.get("batch_max_repos", 50) if self.plugin_config else 50
+        self.batch_max_retries = self.plugin_config.get("batch_max_retries", 2) if self.plugin_config else 2
+        self.batch_retry_backoff = self.plugin_config.get("batch_retry_backoff", 30) if self.plugin_config else 30
+        
+        # 缓存快照配置
+        self.snapshot_path = (self.plugin_config.get("snapshot_path", "") if self.plugin_config else "") or os.path.join("data", "repoinsight_snapshot.jsonl.gz")
+        self.snapshot_load_on_startup = self.plugin_config.get("snapshot_load_on_startup", False) if self.plugin_config else False
+        
+        # 本地片段检索索引配置
+        self.local_index_enabled = self.plugin_config.get("local_index_enabled", True) if self.plugin_config else True
+        self.local_index_max_mb = self.plugin_config.get("local_index_max_mb", 50) if self.plugin_config else 50
+        self.local_index_session_chunks = self.plugin_config.get("local_index_session_chunks", 500) if self.plugin_config else 500
+        self.local_index_min_coverage = self.plugin_config.get("local_index_min_coverage", 0.6) if self.plugin_config else 0.6
+        
         # Embedding配置 - 使用平级配置格式
         self.embedding_config = {
             'provider': self.plugin_config.get("embedding_provider", "qwen") if self.plugin_config else "qwen",
@@ -54,23 +110,234 @@ class Main(Star):
         }
         
         # 初始化状态管理器
-        self.state_manager = StateManager()
+        self.state_manager = StateManager(self._create_state_backend())
+        
+        # 请求飞行记录器
+        # 问答以外的追踪（仓库分析、恢复、批量、预取）本身就要数分钟，使用单独的阈值
+        self.flight_recorder = FlightRecorder(
+            self.trace_buffer_size, self.trace_slow_threshold,
+            {kind: self.trace_slow_threshold_analysis for kind in ("analysis", "resume", "batch", "prefetch")}
+        )
+        
+        # 运行指标与生成模式路由
+        self.metrics = PluginMetrics()
+        self.generation_router = GenerationRouter(self.metrics, self.generation_mode)
+        
+        # 在途任务跟踪，用户离开时取消
+        self.job_tracker = JobTracker(self.metrics, self._cancel_backend_job)
+        # 后端不支持取消接口时记录下来，避免反复请求
+        self._backend_cancel_unsupported = set()
+        
+        # 所有用户共享的预取并发上限，避免预取挤占正常问答
+        self._prefetch_semaphore = asyncio.Semaphore(max(1, self.prefetch_concurrency))
+        
+        # 按 (分析会话ID, 规范化问题) 登记的在途查询，相同问题的提问者共享结果
+        self._shared_queries: Dict[tuple, SharedQuery] = {}
+        
+        # 每个用户最近一次批量分析的进度
+        self._batches: Dict[str, BatchProgress] = {}
+        
+        # 本地片段检索索引
+        self.chunk_index = ChunkIndex(
+            max_bytes=self.local_index_max_mb * 1024 * 1024,
+            max_chunks_per_session=self.local_index_session_chunks,
+            min_coverage=self.local_index_min_coverage
+        ) if self.local_index_enabled else None
+        
+        # 本实例正在处理（持有租约）的任务
+        self._leased_tasks = set()
         
-        # 启动时恢复未完成的任务
-        asyncio.create_task(self._restore_pending_tasks())
+        # 启动时及此后每个租约有效期扫描一次，接管没有实例持有租约的未完成任务
+        self._takeover_task = asyncio.create_task(self._takeover_loop())
+        
+        # 后台定期清理过期任务记录
+        self._retention_task = asyncio.create_task(self._retention_loop())
+        
+        # 后台导入缓存快照，不阻塞插件加载
+        self._snapshot_task = asyncio.create_task(self._load_startup_snapshot()) if self.snapshot_load_on_startup else None
         
         logger.info("RepoInsight插件已初始化")
     
+    def _create_state_backend(self) -> "StateBackend":
+        """根据配置创建状态存储后端，共享后端不可用时回退到本地 SQLite"""
+        if self.state_backend == "redis":
+            try:
+                import redis.asyncio as aioredis
+                logger.info(f"使用 Redis 共享状态后端: {self.state_backend_url}")
+                return KeyValueStateBackend(aioredis.from_url(self.state_backend_url, decode_responses=True))
+            except ImportError:
+                logger.error("未安装 redis 库，回退到本地 SQLite 状态后端")
+        elif self.state_backend == "memory":
+            logger.info("使用进程内键值状态后端")
+            return KeyValueStateBackend(InMemoryKeyValueClient())
+        return SQLiteStateBackend()
+    
+    async def _takeover_loop(self):
+        """定期接管未完成的任务
+
+        实例宕机或重启（包括在租约过期前重启）后，其任务的租约最迟在 lease_ttl 后过期，
+        由下一次扫描接管。
+        """
+        while True:
+            await self._restore_pending_tasks()
+            await asyncio.sleep(self.lease_ttl)
+    
     async def _restore_pending_tasks(self):
-        """恢复插件重启前未完成的任务"""
+        """恢复没有实例处理的未完成任务，通过租约保证每个任务只由一个实例接管"""
         try:
             pending_tasks = await self.state_manager.get_all_pending_tasks()
             for task in pending_tasks:
-                logger.info(f"恢复任务: {task['session_id']} - {task['repo_url']}")
-                # 这里可以添加恢复逻辑，比如重新检查任务状态
+                session_id = task['session_id']
+                if session_id in self._leased_tasks:
+                    continue
+                # 先在本地占位，避免与本实例内新提交的任务重复处理
+                self._leased_tasks.add(session_id)
+                if not await self.state_manager.acquire_lease(session_id, self.instance_id, self.lease_ttl):
+                    self._leased_tasks.discard(session_id)
+                    logger.debug(f"任务由其他实例处理，跳过: {session_id}")
+                    continue
+                logger.info(f"恢复任务: {session_id} - {task['repo_url']}")
+                asyncio.create_task(self._resume_analysis_task(task))
         except Exception as e:
             logger.error(f"恢复任务失败: {e}")
     
+    @contextlib.asynccontextmanager
+    async def _hold_task_lease(self, session_id: str):
+        """处理任务期间持有租约并定期续期，结束后释放
+
+        未能获取租约时不进入处理；处理期间租约丢失时取消当前任务并抛出 TaskLeaseLost，
+        保证同一任务只有一个实例在轮询。
+        """
+        self._leased_tasks.add(session_id)
+        heartbeat = None
+        try:
+            if not await self.state_manager.acquire_lease(session_id, self.instance_id, self.lease_ttl):
+                raise TaskLeaseLost(f"未能获取任务 {session_id} 的租约")
+            heartbeat = asyncio.create_task(self._lease_heartbeat(session_id, asyncio.current_task()))
+            try:
+                yield
+            except asyncio.CancelledError:
+                # 心跳确认租约丢失后取消了本任务，转换为 TaskLeaseLost；其他取消照常传递
+                if heartbeat.done() and not heartbeat.cancelled() and heartbeat.result():
+                    asyncio.current_task().uncancel()
+                    raise TaskLeaseLost(f"任务 {session_id} 的租约已丢失，由其他实例继续处理") from None
+                raise
+        finally:
+            if heartbeat:
+                heartbeat.cancel()
+            await self.state_manager.release_lease(session_id, self.instance_id)
+            self._leased_tasks.discard(session_id)
+    
+    async def _resume_analysis_task(self, task: Dict[str, Any]):
+        """继续轮询之前未完成的分析任务，并将结果通知用户"""
+        try:
+            async with self._hold_task_lease(task['session_id']):
+                await self._poll_resumed_task(task)
+        except TaskLeaseLost as e:
+            logger.warning(f"停止恢复任务: {e}")
+    
+    async def _poll_resumed_task(self, task: Dict[str, Any]):
+        session_id = task['session_id']
+        trace = self.flight_recorder.start("resume", repo=task['repo_url'], user=task['user_origin'], session=session_id)
+        try:
+            await self.state_manager.update_task_status(session_id, TASK_STATUS_PROCESSING)
+            analysis_result = await self._poll_analysis_status(session_id, deadline=Deadline(self.analysis_timeout))
+            trace.outcome = "success" if analysis_result else "failed"
+            if analysis_result:
+                await self.state_manager.update_task_status(session_id, TASK_STATUS_SUCCESS)
+                await self._register_analysis(task['repo_url'], session_id)
+                message = f"✅ 插件重启前提交的仓库分析已完成: {task['repo_url']}\n发送 /repo_qa 并输入该仓库URL即可直接提问"
+            else:
+                await self.state_manager.update_task_status(session_id, TASK_STATUS_FAILED, "仓库分析失败")
+                message = f"❌ 插件重启前提交的仓库分析失败: {task['repo_url']}"
+            await self.context.send_message(task['user_origin'], MessageChain().message(message))
+        except DeadlineExceeded as e:
+            logger.warning(f"恢复任务 {session_id} 超时: {e}")
+            trace.outcome = "deadline"
+            await self.state_manager.update_task_status(session_id, TASK_STATUS_FAILED, f"分析超时: {e}")
+            await self._cancel_backend_job(TrackedJob(task['user_origin'], "resume", asyncio.current_task(), session_id))
+            await self.context.send_message(
+                task['user_origin'],
+                MessageChain().message(f"⏰ 插件重启前提交的仓库分析超时: {task['repo_url']}\n{e}")
+            )
+        except Exception as e:
+            logger.error(f"恢复任务 {session_id} 失败: {e}")
+            trace.outcome = "error"
+        finally:
+            self.flight_recorder.finish(trace)
+    
+    async def _register_analysis(self, repo_url: str, analysis_session_id: str):
+        """登记仓库的分析结果，被取代的旧分析会话的本地片段随之淘汰"""
+        previous = await self.state_manager.get_analysis(repo_url, float("inf"))
+        await self.state_manager.register_analysis(repo_url, analysis_session_id)
+        if self.chunk_index and previous and previous != analysis_session_id:
+            await self.chunk_index.evict_session(previous)
+    
+    async def _lease_heartbeat(self, task_id: str, holder: asyncio.Task) -> bool:
+        """在持有任务期间定期续期租约
+
+        存储出错时缩短间隔重试，只有租约确实已归其他实例或在重试期间过期才视为丢失，
+        此时取消持有租约的任务 holder 并返回 True。
+        """
+        expires_at = time.monotonic() + self.lease_ttl
+        interval = self.lease_ttl / 3
+        while True:
+            await asyncio.sleep(min(interval, max(0.0, expires_at - time.monotonic())))
+            attempted_at = time.monotonic()
+            try:
+                renewed = await self.state_manager.renew_lease(task_id, self.instance_id, self.lease_ttl)
+            except Exception as e:
+                if time.monotonic() < expires_at:
+                    logger.warning(f"续期任务租约出错，稍后重试: {task_id} - {e}")
+                    interval = self.lease_ttl / 10
+                    continue
+                renewed = False
+            if renewed:
+                expires_at = attempted_at + self.lease_ttl
+                interval = self.lease_ttl / 3
+                continue
+            logger.warning(f"任务租约已丢失，停止处理: {task_id}")
+            self.metrics.incr("lease.lost")
+            holder.cancel()
+            return True
+    
+    async def _load_startup_snapshot(self):
+        """启动时导入缓存快照，让新节点不必重新分析热门仓库"""
+        if not os.path.exists(self.snapshot_path):
+            logger.info(f"缓存快照不存在，跳过导入: {self.snapshot_path}")
+            return
+        try:
+            started = time.monotonic()
+            result = await CacheSnapshot(self.state_manager).load(
+                self.snapshot_path, self.analysis_cache_ttl, self.answer_cache_ttl
+            )
+            logger.info(
+                f"已导入缓存快照 {self.snapshot_path}: 仓库 {result['analyses']} 个，答案 {result['answers']} 条，"
+                f"跳过过期记录 {result['expired']} 条，耗时 {time.monotonic() - started:.1f}秒"
+            )
+            if not result['complete']:
+                logger.warning(f"缓存快照不完整，仅导入了可读取的部分: {self.snapshot_path}")
+        except Exception as e:
+            logger.error(f"导入缓存快照失败: {e}")
+    
+    async def _retention_loop(self):
+        """定期归档/清理过期任务并执行增量 VACUUM"""
+        while True:
+            try:
+                purged = await self.state_manager.purge_old_tasks(
+                    self.task_retention_days,
+                    archive=self.task_retention_archive,
+                    archive_retention_days=self.task_archive_retention_days,
+                    answer_cache_ttl=self.answer_cache_ttl
+                )
+                if purged:
+                    logger.info(f"已清理 {purged} 条过期任务记录")
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"清理过期任务失败: {e}")
+            await asyncio.sleep(self.retention_check_interval)
+    
     @filter.command("repo_qa")
     async def repo_qa_session(self, event: AstrMessageEvent):
         """启动仓库问答会话"""
@@ -86,11 +353,10 @@ class Main(Star):
             @session_waiter(timeout=7200)
             async def session_handler(controller: SessionController, event: AstrMessageEvent):
                 """处理会话的函数 - 使用状态管理的事件驱动模式"""
-                logger.info(f"进入session_handler，当前状态: {self.state_manager.user_states}")
-                
                 # 获取或初始化当前用户的状态
                 user_id = event.unified_msg_origin
                 user_state = await self.state_manager.get_user_state(user_id)
+                logger.info(f"进入session_handler，当前状态: {user_state}")
                 
                 # 重要：禁止AstrBot默认的LLM调用，避免冲突
                 event.should_call_llm(False)
@@ -107,15 +373,16 @@ class Main(Star):
                 
                 # 检查是否为退出命令
                 if user_input.lower() in ['退出', 'exit', 'quit', '取消']:
+                    await self.job_tracker.cancel_user(user_id, "exit")
                     await event.send(event.plain_result("👋 感谢使用 RepoInsight！"))
-                    if user_state.get('analysis_session_id'):
-                        await self.state_manager.remove_task(user_state['analysis_session_id'])
+                    # 任务记录保留用于 /repo_status 查询，由后台保留策略统一清理
                     await self.state_manager.clear_user_state(user_id)
                     controller.stop()
                     return
                 
                 # 检查是否为切换仓库命令
                 if user_input.lower().startswith('/repo_qa') or user_input.lower().startswith('repo_qa'):
+                    await self.job_tracker.cancel_user(user_id, "switch")
                     await event.send(event.plain_result("🔄 请发送您要分析的新 GitHub 仓库 URL："))
                     # 重置状态
                     await self.state_manager.clear_user_state(user_id)
@@ -132,9 +399,26 @@ class Main(Star):
                         ))
                         return
                     
-                    repo_url = user_input
+                    repo_url = user_input.rstrip('/')
                     logger.info(f"开始处理仓库URL: {repo_url}")
                     
+                    # 切换仓库时放弃之前仓库的在途分析和问题
+                    await self.job_tracker.cancel_user(user_id, "switch")
+                    
+                    # 已分析过的仓库（包括其他实例分析的）直接复用
+                    cached_session_id = await self.state_manager.get_analysis(repo_url, self.analysis_cache_ttl)
+                    if cached_session_id:
+                        logger.info(f"复用已分析仓库: {repo_url} -> {cached_session_id}")
+                        await self.state_manager.set_user_state(user_id, {
+                            'current_repo_url': repo_url,
+                            'analysis_session_id': cached_session_id
+                        })
+                        await event.send(event.plain_result(
+                            f"✅ 该仓库已分析过，现在您可以直接提问了！\n\n🔗 仓库: {repo_url}\n"
+                            f"• 发送 '退出' 结束会话"
+                        ))
+                        return
+                    
                     # 如果是切换到新仓库
                     current_repo_url = user_state.get('current_repo_url')
                     if current_repo_url and repo_url != current_repo_url:
@@ -142,34 +426,68 @@ class Main(Star):
                     else:
                         await event.send(event.plain_result(f"🔍 开始分析仓库，⏳请稍候..."))
                     
+                    trace = self.flight_recorder.start("analysis", repo=repo_url, user=user_id)
+                    # 整个分析（提交 + 轮询）共享同一个时间预算
+                    deadline = Deadline(self.analysis_timeout)
+                    new_analysis_session_id = None
+                    analysis_job = None
                     try:
                         # 启动仓库分析
-                        logger.info(f"启动仓库分析: {repo_url}")
-                        new_analysis_session_id = await self._start_repository_analysis(repo_url)
+                        logger.info(f"启动仓库分析: {repo_url} (trace={trace.trace_id})")
+                        new_analysis_session_id = await self._submit_analysis(user_id, repo_url, deadline)
                         logger.info(f"分析会话ID: {new_analysis_session_id}")
                         
                         if not new_analysis_session_id:
                             logger.error("启动仓库分析失败")
+                            trace.outcome = "submit_failed"
                             await event.send(event.plain_result("❌ 启动仓库分析失败，请稍后重试或尝试其他仓库"))
                             return
                         
-                        # 保存任务状态
-                        await self.state_manager.add_task(new_analysis_session_id, repo_url, user_id)
-                        
-                        # 轮询分析状态
-                        analysis_result = await self._poll_analysis_status(new_analysis_session_id, event)
+                        # 先持有租约再保存任务，避免其他实例或接管扫描重复轮询
+                        async with self._hold_task_lease(new_analysis_session_id):
+                            await self.state_manager.add_task(new_analysis_session_id, repo_url, user_id)
+                            
+                            # 轮询分析状态
+                            try:
+                                await self.state_manager.update_task_status(new_analysis_session_id, TASK_STATUS_PROCESSING)
+                                analysis_job = self.job_tracker.start(
+                                    user_id, "analysis",
+                                    self._poll_analysis_status(new_analysis_session_id, event, deadline),
+                                    backend_id=new_analysis_session_id
+                                )
+                                analysis_result = await analysis_job.wait()
+                            except JobCancelled as e:
+                                trace.outcome = "cancelled"
+                                await self.state_manager.update_task_status(new_analysis_session_id, TASK_STATUS_CANCELLED, str(e))
+                                return
                         if not analysis_result:
-                            await self.state_manager.remove_task(new_analysis_session_id)
+                            trace.outcome = "failed"
+                            await self.state_manager.update_task_status(new_analysis_session_id, TASK_STATUS_FAILED, "仓库分析失败")
                             await event.send(event.plain_result("❌ 仓库分析失败，请稍后重试或尝试其他仓库"))
                             return
                         
+                        trace.outcome = "success"
+                        
+                        await self.state_manager.update_task_status(new_analysis_session_id, TASK_STATUS_SUCCESS)
+                        await self._register_analysis(repo_url, new_analysis_session_id)
+                        
                         # 分析成功，更新用户状态
                         await self.state_manager.set_user_state(user_id, {
                             'current_repo_url': repo_url,
-                            'analysis_session_id': new_analysis_session_id,
-                            'processing_questions': set()
+                            'analysis_session_id': new_analysis_session_id
                         })
                         
+                        prefetch_hint = ""
+                        if self.prefetch_enabled:
+                            self.job_tracker.start(
+                                user_id, "prefetch",
+                                self._prefetch_common_questions(user_id, repo_url, new_analysis_session_id)
+                            )
+                            # 预取答案按问题原文缓存，列出问题方便用户直接发送
+                            prefetch_hint = "\n\n📌 **常见问题（已在后台准备答案，可直接复制发送）:**\n" + "\n".join(
+                                f"• {question}" for question in self.prefetch_questions[:self.prefetch_max_questions]
+                            )
+                        
                         await event.send(event.plain_result(
                             f"✅ 仓库分析完成！现在您可以开始提问了！\n"
                             f"💡 **提示:**\n"
@@ -177,66 +495,94 @@ class Main(Star):
                             f"• 发送新的仓库URL可以快速切换\n"
                             f"• 发送 '/repo_qa' 切换到新仓库\n"
                             f"• 发送 '退出' 结束会话"
+                            f"{prefetch_hint}"
                         ))
                         return
                         
+                    except DeadlineExceeded as e:
+                        logger.warning(f"仓库分析超时: {e} (trace={trace.trace_id})")
+                        trace.outcome = "deadline"
+                        if new_analysis_session_id:
+                            await self.state_manager.update_task_status(new_analysis_session_id, TASK_STATUS_FAILED, f"分析超时: {e}")
+                        # 超时后不再轮询，同时让 GithubBot 停止分析
+                        if analysis_job:
+                            await self._cancel_backend_job(analysis_job)
+                        await event.send(event.plain_result(f"⏰ 仓库分析超时：{e}，请稍后重试"))
+                        return
+                    except JobCancelled:
+                        # 提交期间用户已退出或切换仓库，后端作业由 _submit_analysis 取消
+                        trace.outcome = "cancelled"
+                        return
+                    except TaskLeaseLost as e:
+                        logger.warning(f"{e} (trace={trace.trace_id})")
+                        trace.outcome = "lease_lost"
+                        if analysis_job:
+                            # 轮询期间租约丢失，由接管的实例继续轮询并通知用户
+                            await event.send(event.plain_result("⚠️ 分析任务已转由其他实例处理，完成后会另行通知您"))
+                        else:
+                            await event.send(event.plain_result("❌ 登记分析任务失败，请稍后重试"))
+                        return
                     except Exception as e:
-                        logger.error(f"仓库处理过程出错: {e}")
+                        logger.error(f"仓库处理过程出错: {e} (trace={trace.trace_id})")
+                        trace.outcome = "error"
                         await event.send(event.plain_result(f"❌ 处理过程出错: {str(e)}"))
                         return
+                    finally:
+                        self.flight_recorder.finish(trace)
                 
                 # 如果已经有分析好的仓库，处理用户问题
                 elif user_state.get('current_repo_url') and user_state.get('analysis_session_id'):
                     user_question = user_input
                     current_repo_url = user_state['current_repo_url']
                     analysis_session_id = user_state['analysis_session_id']
-                    processing_questions = user_state.get('processing_questions', set())
-                    
-                    # 检查是否正在处理相同问题（防止并发处理）
-                    question_hash = hash(user_question)
-                    
-                    if question_hash in processing_questions:
-                        logger.info(f"问题正在处理中: {user_question}")
-                        await event.send(event.plain_result("此问题正在处理中，请稍候..."))
-                        return
                     
-                    # 标记问题为正在处理
-                    processing_questions.add(question_hash)
-                    await self.state_manager.set_user_state(user_id, {
-                        **user_state,
-                        'processing_questions': processing_questions
-                    })
-                    
-                    logger.info(f"开始处理问题: {user_question[:50]}... - 仓库: {current_repo_url}")
+                    trace = self.flight_recorder.start("question", repo=current_repo_url, user=user_id)
+                    logger.info(f"开始处理问题: {user_question[:50]}... - 仓库: {current_repo_url} (trace={trace.trace_id})")
+                    # 从收到问题开始计时，本地生成、提交、轮询和获取结果共享同一个时间预算
+                    deadline = Deadline(self.query_timeout)
                          
                     try:
-                        # 提交查询请求，使用仓库URL作为session_id
-                        query_session_id = await self._submit_query(analysis_session_id, user_question)
-                        if not query_session_id:
-                            await event.send(event.plain_result("❌ 提交问题失败，请重试"))
+                        # 相同仓库的相同问题直接使用缓存答案
+                        cached_answer = await self.state_manager.get_cached_answer(
+                            analysis_session_id, user_question, self.answer_cache_ttl
+                        )
+                        if cached_answer:
+                            logger.info(f"命中答案缓存: {user_question[:50]}")
+                            trace.outcome = "cached"
+                            trace.event("answer_cache_hit")
+                            await self._send_long_message(event, f"💡 **回答:**\n\n{cached_answer}")
                             return
                         
-                        # 轮询查询结果
-                        answer = await self._poll_query_result(query_session_id, event)
+                        # 相同问题正在处理时（无论来自哪个用户）等待同一个查询的结果
+                        answer, outcome, joined = await self._ask_shared_question(
+                            user_id, analysis_session_id, user_question, deadline
+                        )
+                        trace.outcome = "shared" if joined and answer else outcome
                         if answer:
                             # 智能分段发送长回答
                             await self._send_long_message(event, f"💡 **回答:**\n\n{answer}")
+                        elif outcome == "submit_failed":
+                            await event.send(event.plain_result("❌ 提交问题失败，请重试"))
                         else:
                             await event.send(event.plain_result("❌ 获取答案失败，请重试"))
                         
                         return
                         
+                    except JobCancelled:
+                        trace.outcome = "cancelled"
+                        return
+                    except DeadlineExceeded as e:
+                        logger.warning(f"问题处理超时: {e} (trace={trace.trace_id})")
+                        trace.outcome = "deadline"
+                        await event.send(event.plain_result(f"⏰ 问题处理超时：{e}，请稍后重试或换个问法"))
+                        return
                     except Exception as e:
-                        logger.error(f"处理问题时出错: {e}")
+                        logger.error(f"处理问题时出错: {e} (trace={trace.trace_id})")
+                        trace.outcome = "error"
                         await event.send(event.plain_result(f"❌ 处理问题时出错: {str(e)}"))
                         return
                     finally:
-                        # 无论成功还是失败，都要移除正在处理标记
-                        processing_questions.discard(question_hash)
-                        await self.state_manager.set_user_state(user_id, {
-                            **user_state,
-                            'processing_questions': processing_questions
-                        })
+                        self.flight_recorder.finish(trace)
                 
                 else:
                     # 应该不会到达这里，但保险起见
@@ -247,6 +593,7 @@ class Main(Star):
             try:
                 await session_handler(event)
             except TimeoutError:
+                await self.job_tracker.cancel_user(event.unified_msg_origin, "timeout")
                 await event.send(event.plain_result("⏰ 会话超时，请重新发送 /repo_qa 命令开始新的会话"))
             except Exception as e:
                 logger.error(f"会话处理器异常: {e}")
@@ -259,20 +606,339 @@ class Main(Star):
             logger.error(f"启动仓库问答会话失败: {e}")
             await event.send(event.plain_result(f"❌ 启动会话失败: {str(e)}"))
     
+    async def _ask_shared_question(self, user_id: str, analysis_session_id: str, question: str,
+                                   deadline: "Deadline", generation_mode: Optional[str] = None,
+                                   wait_kind: str = "query") -> tuple:
+        """回答问题，同一仓库的相同问题在途时与其他提问者（包括其他用户和预取）共享同一个查询
+
+        第一个提问者发起查询（使用其生成模式），之后的提问者只等待结果。查询的截止时间取所有提问者
+        截止时间中最晚的一个，每个提问者最多等到自己的截止时间。每个提问者的等待登记为自己的
+        wait_kind 任务，退出或超时时只结束自己的等待；最后一个提问者离开时才取消共享查询及其后端作业。
+        返回 (答案, 结果, 是否加入了已有查询)。
+        """
+        key = (analysis_session_id, normalize_question(question))
+        shared = self._shared_queries.get(key)
+        joined = shared is not None
+        if joined:
+            logger.info(f"相同问题正在处理，等待共享结果: {question[:50]}")
+            self.metrics.incr("query.shared")
+            FlightRecorder.record("shared_query_joined")
+            shared.deadline.extend_to(deadline)
+        else:
+            shared = SharedQuery(f"shared:{analysis_session_id}:{question_key(question)}", copy.copy(deadline))
+            shared.job = self.job_tracker.start(
+                shared.tracker_key, "shared_query",
+                self._answer_question(analysis_session_id, question, shared.deadline, shared.tracker_key, generation_mode)
+            )
+            self._shared_queries[key] = shared
+            shared.job.task.add_done_callback(lambda _: self._discard_shared_query(key, shared))
+        
+        shared.waiters += 1
+        wait_job = self.job_tracker.start(user_id, wait_kind, self._wait_shared_query(shared, deadline))
+        try:
+            answer, outcome = await wait_job.wait()
+            return answer, outcome, joined
+        finally:
+            shared.waiters -= 1
+            if shared.waiters == 0 and not shared.job.task.done():
+                await self.job_tracker.cancel_user(shared.tracker_key, "abandoned")
+    
+    async def _wait_shared_query(self, shared: "SharedQuery", deadline: "Deadline"):
+        # 取消某个提问者的等待或其预算用尽都不影响共享查询本身
+        return await deadline.run(asyncio.shield(shared.job.task), "等待共享结果")
+    
+    def _discard_shared_query(self, key: tuple, shared: "SharedQuery"):
+        if self._shared_queries.get(key) is shared:
+            del self._shared_queries[key]
+        # 所有提问者都离开后共享查询以 JobCancelled 结束，此时已没有人读取它的异常
+        if not shared.job.task.cancelled():
+            shared.job.task.exception()
+    
+    async def _answer_question(self, analysis_session_id: str, question: str, deadline: "Deadline",
+                               tracker_key: str, generation_mode: Optional[str] = None) -> tuple:
+        """依次尝试本地索引和 GithubBot 查询来回答问题，返回 (答案, 结果)
+
+        指定 generation_mode 时跳过本地索引和模式路由，直接以该模式提交查询。
+        """
+        # 本地索引覆盖充分时直接用本地片段生成答案，省去一次 GithubBot 检索；强制 service 模式时不在本地生成
+        plugin_available = self.context.get_using_provider() is not None
+        use_local = plugin_available and not generation_mode and self.generation_router.forced_mode != "service"
+        answer = await self._answer_from_local_index(analysis_session_id, question, deadline) if use_local else None
+        if answer:
+            await self.state_manager.cache_answer(analysis_session_id, question, answer, self.answer_cache_ttl)
+            return answer, "local"
+        
+        # 选择更快且健康的生成模式
+        generation_mode = generation_mode or self.generation_router.choose(plugin_available=plugin_available)
+        query_started = time.monotonic()
+        query_job = None
+        try:
+            query_session_id = await self._submit_query(analysis_session_id, question, generation_mode, deadline)
+            if not query_session_id:
+                self.generation_router.record(generation_mode, time.monotonic() - query_started, False)
+                return None, "submit_failed"
+            
+            # 轮询查询结果
+            query_job = self.job_tracker.start(
+                tracker_key, "query",
+                self._poll_query_result(query_session_id, None, analysis_session_id, deadline),
+                backend_id=query_session_id, backend_kind="query"
+            )
+            answer = await query_job.wait()
+        except DeadlineExceeded:
+            self.generation_router.record(generation_mode, time.monotonic() - query_started, False)
+            # 已无人等待结果，让 GithubBot 停止这次查询
+            if query_job:
+                await self._cancel_backend_job(query_job)
+            raise
+        
+        self.generation_router.record(generation_mode, time.monotonic() - query_started, bool(answer))
+        if not answer:
+            return None, "failed"
+        await self.state_manager.cache_answer(analysis_session_id, question, answer, self.answer_cache_ttl)
+        return answer, "success"
+    
+    async def _prefetch_common_questions(self, user_id: str, repo_url: str, analysis_session_id: str):
+        """后台低优先级预取常见问题的答案并写入答案缓存
+
+        每次只处理一个问题，用户自己的问题在途时让路；达到问题数或时间预算后停止。
+        作为 prefetch 任务登记在 JobTracker 中，用户离开时随之取消。
+        """
+        trace = self.flight_recorder.start("prefetch", repo=repo_url, user=user_id)
+        # 预取的时间预算作为所有预取问题共享的截止时间，单个问题不会越过它
+        deadline = Deadline(self.prefetch_budget_seconds)
+        prefetched = 0
+        try:
+            async with self._prefetch_semaphore:
+                for question in self.prefetch_questions[:self.prefetch_max_questions]:
+                    if await self.state_manager.get_cached_answer(analysis_session_id, question, self.answer_cache_ttl):
+                        continue
+                    
+                    # 用户自己的问题优先
+                    while any(job.kind == "query" for job in self.job_tracker.active(user_id)):
+                        await deadline.sleep(self.poll_interval, "等待用户问题")
+                    
+                    # 作为共享查询提交，用户在预取途中问到同一问题时直接等待这次查询的结果；
+                    # 答案由共享查询写入缓存
+                    answer, _, _ = await self._ask_shared_question(
+                        user_id, analysis_session_id, question, deadline,
+                        generation_mode="service", wait_kind="prefetch_query"
+                    )
+                    if answer:
+                        prefetched += 1
+                        self.metrics.incr("prefetch.answered")
+                    else:
+                        self.metrics.incr("prefetch.error")
+            trace.outcome = "success"
+            logger.info(f"预取完成: {repo_url}，缓存 {prefetched} 个答案")
+        except DeadlineExceeded:
+            trace.outcome = "deadline"
+            logger.info(f"预取时间预算已用完: {repo_url}，缓存 {prefetched} 个答案")
+            self.metrics.incr("prefetch.budget_exhausted")
+        except (JobCancelled, asyncio.CancelledError):
+            trace.outcome = "cancelled"
+            logger.info(f"预取已取消: {repo_url}")
+        except Exception as e:
+            trace.outcome = "error"
+            logger.error(f"预取常见问题失败: {e}")
+        finally:
+            self.flight_recorder.finish(trace)
+    
+    async def _list_owner_repositories(self, owner: str) -> Optional[list]:
+        """通过 GitHub API 列出用户或组织的公开仓库（不含 fork 和已归档仓库），请求失败时返回 None"""
+        repo_urls = []
+        page = 1
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+                while len(repo_urls) < self.batch_max_repos:
+                    async with session.get(
+                        f"https://api.github.com/users/{owner}/repos",
+                        params={"per_page": 100, "page": page, "sort": "pushed"},
+                        headers={"Accept": "application/vnd.github+json"}
+                    ) as response:
+                        if response.status == 404:
+                            return []
+                        if response.status != 200:
+                            logger.error(f"获取 {owner} 的仓库列表失败: {response.status} - {await response.text()}")
+                            return None
+                        repos = await response.json()
+                    repo_urls.extend(
+                        repo['html_url'] for repo in repos
+                        if not repo.get('fork') and not repo.get('archived')
+                    )
+                    if len(repos) < 100:
+                        break
+                    page += 1
+        except Exception as e:
+            logger.error(f"获取 {owner} 的仓库列表失败: {e}")
+            return None
+        return repo_urls[:self.batch_max_repos]
+    
+    async def _run_batch(self, user_id: str, progress: "BatchProgress"):
+        """以有限并发分析一批仓库，失败的仓库按指数退避重试，并定期向用户汇报总体进度
+
+        作为 batch 任务登记在 JobTracker 的 batch:<用户> 下，与 /repo_qa 会话的任务互不影响。
+        """
+        batch_key = f"batch:{user_id}"
+        semaphore = asyncio.Semaphore(max(1, self.batch_concurrency))
+        
+        async def analyze(repo_url: str):
+            if await self.state_manager.get_analysis(repo_url, self.analysis_cache_ttl):
+                progress.set(repo_url, "reused")
+                self.metrics.incr("batch.reused")
+            else:
+                for attempt in range(self.batch_max_retries + 1):
+                    if attempt:
+                        # 退避期间不占用并发名额
+                        progress.set(repo_url, "retrying")
+                        self.metrics.incr("batch.retry")
+                        await asyncio.sleep(self.batch_retry_backoff * 2 ** (attempt - 1))
+                    async with semaphore:
+                        progress.attempts[repo_url] += 1
+                        progress.set(repo_url, "running")
+                        error = await self._analyze_batch_repository(batch_key, user_id, repo_url)
+                    if error is None:
+                        progress.set(repo_url, "success")
+                        self.metrics.incr("batch.success")
+                        break
+                    progress.errors[repo_url] = error
+                else:
+                    progress.set(repo_url, "failed")
+                    self.metrics.incr("batch.failed")
+            
+            if progress.finished() < len(progress.repo_urls) and time.monotonic() - progress.last_report >= BATCH_PROGRESS_INTERVAL:
+                progress.last_report = time.monotonic()
+                await self.context.send_message(user_id, MessageChain().message(progress.format()))
+        
+        try:
+            await asyncio.gather(*(analyze(url) for url in progress.repo_urls))
+            ready = [url for url in progress.repo_urls if progress.statuses[url] in ("success", "reused")]
+            message = f"🏁 批量分析结束\n\n{progress.format(detail=True)}"
+            if ready:
+                message += "\n\n💡 发送 /repo_qa 并输入以上任一已完成的仓库URL即可直接提问"
+            await self.context.send_message(user_id, MessageChain().message(message))
+            logger.info(f"批量分析结束: {user_id}，成功 {len(ready)}/{len(progress.repo_urls)}")
+        except asyncio.CancelledError:
+            for url, status in progress.statuses.items():
+                if status not in BATCH_FINISHED_STATUSES:
+                    progress.set(url, "cancelled")
+            logger.info(f"批量分析已取消: {user_id}")
+            raise
+        except Exception as e:
+            logger.error(f"批量分析失败: {e}")
+            await self.context.send_message(user_id, MessageChain().message(f"❌ 批量分析出错: {str(e)}"))
+    
+    async def _analyze_batch_repository(self, batch_key: str, user_id: str, repo_url: str) -> Optional[str]:
+        """分析批量中的一个仓库并登记到分析注册表，成功返回 None，失败返回原因"""
+        trace = self.flight_recorder.start("batch", repo=repo_url, user=user_id)
+        deadline = Deadline(self.analysis_timeout)
+        session_id = None
+        analysis_job = None
+        try:
+            session_id = await self._submit_analysis(batch_key, repo_url, deadline)
+            if not session_id:
+                trace.outcome = "submit_failed"
+                return "启动分析失败"
+            
+            # 与 /repo_qa 一样持有租约并记录任务，重启后可由接管扫描恢复
+            async with self._hold_task_lease(session_id):
+                await self.state_manager.add_task(session_id, repo_url, user_id)
+                await self.state_manager.update_task_status(session_id, TASK_STATUS_PROCESSING)
+                analysis_job = self.job_tracker.start(
+                    batch_key, "analysis",
+                    self._poll_analysis_status(session_id, None, deadline),
+                    backend_id=session_id
+                )
+                analysis_result = await analysis_job.wait()
+            
+            if not analysis_result:
+                trace.outcome = "failed"
+                await self.state_manager.update_task_status(session_id, TASK_STATUS_FAILED, "仓库分析失败")
+                return "仓库分析失败"
+            
+            trace.outcome = "success"
+            await self.state_manager.update_task_status(session_id, TASK_STATUS_SUCCESS)
+            await self._register_analysis(repo_url, session_id)
+            return None
+        except DeadlineExceeded as e:
+            trace.outcome = "deadline"
+            if session_id:
+                await self.state_manager.update_task_status(session_id, TASK_STATUS_FAILED, f"分析超时: {e}")
+            if analysis_job:
+                await self._cancel_backend_job(analysis_job)
+            return f"分析超时: {e}"
+        except (JobCancelled, asyncio.CancelledError):
+            trace.outcome = "cancelled"
+            if session_id:
+                await self.state_manager.update_task_status(session_id, TASK_STATUS_CANCELLED, "批量分析已取消")
+            raise
+        except Exception as e:
+            logger.error(f"批量分析仓库 {repo_url} 出错: {e} (trace={trace.trace_id})")
+            trace.outcome = "error"
+            return str(e)
+        finally:
+            self.flight_recorder.finish(trace)
+    
+    async def _cancel_backend_job(self, job: "TrackedJob"):
+        """请求 GithubBot 取消作业；接口不存在（404/405）时记住并不再尝试"""
+        if job.backend_kind in self._backend_cancel_unsupported:
+            return
+        path = "query/cancel" if job.backend_kind == "query" else "cancel"
+        try:
+            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+                async with session.post(f"{self.api_base_url}/api/v1/repos/{path}/{job.backend_id}") as response:
+                    if response.status in (404, 405):
+                        logger.info(f"GithubBot 不支持取消{job.backend_kind}作业，后续仅停止本地轮询")
+                        self._backend_cancel_unsupported.add(job.backend_kind)
+                        self.metrics.incr("jobs.backend_cancel.unsupported")
+                    elif response.status < 300:
+                        self.metrics.incr("jobs.backend_cancel.ok")
+                    else:
+                        logger.warning(f"取消后端作业失败: {response.status}")
+                        self.metrics.incr("jobs.backend_cancel.failed")
+        except Exception as e:
+            logger.warning(f"取消后端作业请求失败: {e}")
+            self.metrics.incr("jobs.backend_cancel.failed")
+    
     def _is_valid_github_url(self, url: str) -> bool:
         """验证GitHub URL格式"""
         github_pattern = r'^https://github\.com/[\w\.-]+/[\w\.-]+/?$'
         return bool(re.match(github_pattern, url))
     
-    async def _start_repository_analysis(self, repo_url: str) -> Optional[str]:
+    async def _submit_analysis(self, tracker_key: str, repo_url: str, deadline: "Deadline") -> Optional[str]:
+        """提交仓库分析并登记到 JobTracker
+
+        提交请求本身不中断：提交期间用户退出或切换仓库时，等 GithubBot 返回会话ID后
+        再取消这个已无人等待的分析作业。
+        """
+        submission = asyncio.create_task(self._start_repository_analysis(repo_url, deadline))
+        submit_job = self.job_tracker.start(tracker_key, "analysis_submit", asyncio.shield(submission))
+        try:
+            return await submit_job.wait()
+        except (JobCancelled, asyncio.CancelledError):
+            asyncio.create_task(self._cancel_abandoned_submission(tracker_key, submission))
+            raise
+    
+    async def _cancel_abandoned_submission(self, tracker_key: str, submission: asyncio.Task):
+        """等待被放弃的提交返回，并取消它在 GithubBot 上创建的分析作业"""
+        try:
+            session_id = await submission
+        except Exception:
+            return
+        if session_id:
+            logger.info(f"提交期间 {tracker_key} 已离开，取消分析作业 {session_id}")
+            await self._cancel_backend_job(TrackedJob(tracker_key, "analysis", submission, session_id))
+    
+    async def _start_repository_analysis(self, repo_url: str, deadline: Optional["Deadline"] = None) -> Optional[str]:
         """启动仓库分析"""
+        deadline = deadline or Deadline(self.analysis_timeout)
         try:
             logger.info(f"=== 开始启动仓库分析 ===")
             logger.info(f"仓库URL: {repo_url}")
             logger.info(f"API地址: {self.api_base_url}")
-            logger.info(f"超时设置: {self.timeout}秒")
+            logger.info(f"超时设置: 单次请求 {self.timeout}秒，剩余预算 {deadline.remaining():.0f}秒")
             
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.timeout)) as session:
+            async with aiohttp.ClientSession(timeout=deadline.http_timeout("启动分析", self.timeout), headers=FlightRecorder.headers()) as session:
                 payload = {
                     "repo_url": repo_url,
                     "embedding_config": self.embedding_config
@@ -286,6 +952,7 @@ class Main(Star):
                     headers={"Content-Type": "application/json"}
                 ) as response:
                     logger.info(f"HTTP响应状态: {response.status}")
+                    FlightRecorder.record("analyze_submit", http=response.status)
                     
                     if response.status == 200:
                         result = await response.json()
@@ -297,50 +964,73 @@ class Main(Star):
                         error_text = await response.text()
                         logger.error(f"启动分析失败: {response.status} - {error_text}")
                         return None
+        except DeadlineExceeded:
+            raise
+        except asyncio.TimeoutError:
+            deadline.check("启动分析")
+            logger.error(f"启动仓库分析请求超时: 超过单次请求超时 {self.timeout}秒")
+            return None
         except Exception as e:
             logger.error(f"启动仓库分析请求失败: {e}")
             logger.error(f"异常详情: {str(e)}")
             return None
     
-    async def _poll_analysis_status(self, session_id: str, event: AstrMessageEvent) -> Optional[Dict[str, Any]]:
-        """轮询分析状态"""
+    async def _poll_analysis_status(self, session_id: str, event: Optional[AstrMessageEvent] = None,
+                                    deadline: Optional["Deadline"] = None) -> Optional[Dict[str, Any]]:
+        """轮询分析状态，event 为空时（如恢复任务）不向用户发送消息"""
+        deadline = deadline or Deadline(self.analysis_timeout)
         try:
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.query_timeout)) as session:
+            async with aiohttp.ClientSession(headers=FlightRecorder.headers()) as session:
+                last_status = None
                 while True:
                     async with session.get(
-                        f"{self.api_base_url}/api/v1/repos/status/{session_id}"
+                        f"{self.api_base_url}/api/v1/repos/status/{session_id}",
+                        timeout=deadline.http_timeout("分析轮询", self.timeout)
                     ) as response:
                         if response.status == 200:
                             result = await response.json()
                             status = result.get('status')
+                            if status != last_status:
+                                FlightRecorder.record("analysis_status", status=status)
+                                last_status = status
                             
                             if status == 'success':
                                 return result
                             elif status == 'failed':
                                 error_msg = result.get('error_message', '未知错误')
-                                await event.send(event.plain_result(f"❌ 分析失败: {error_msg}"))
+                                logger.error(f"仓库分析失败: {error_msg}")
+                                if event:
+                                    await event.send(event.plain_result(f"❌ 分析失败: {error_msg}"))
                                 return None
                             elif status in ['queued', 'processing']:
                                 # 静默等待，不发送进度消息
                                 pass
                             
-                            await asyncio.sleep(self.poll_interval)
+                            await deadline.sleep(self.poll_interval, "分析轮询")
                         else:
                             logger.error(f"查询分析状态失败: {response.status}")
                             return None
+        except DeadlineExceeded:
+            raise
+        except asyncio.TimeoutError:
+            deadline.check("分析轮询")
+            logger.error(f"查询分析状态超时: 超过单次请求超时 {self.timeout}秒")
+            return None
         except Exception as e:
             logger.error(f"轮询分析状态失败: {e}")
             return None
     
-    async def _submit_query(self, session_id: str, question: str) -> Optional[str]:
-        """提交查询请求"""
+    async def _submit_query(self, session_id: str, question: str, generation_mode: str = "service",
+                            deadline: Optional["Deadline"] = None) -> Optional[str]:
+        """提交查询请求，generation_mode 为 plugin 时由插件使用 AstrBot 的 LLM 生成答案"""
+        deadline = deadline or Deadline(self.query_timeout)
         try:
             logger.info(f"提交查询请求: session_id={session_id}, question={question[:100]}...")
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.query_timeout)) as session:
+            async with aiohttp.ClientSession(timeout=deadline.http_timeout("提交问题", self.timeout), headers=FlightRecorder.headers()) as session:
                 payload = {
                     "session_id": session_id,
                     "question": question,
-                    "generation_mode": "service",
+                    "generation_mode": generation_mode,
                     "llm_config": self.llm_config
                 }
                 
@@ -351,6 +1041,7 @@ class Main(Star):
                     json=payload,
                     headers={"Content-Type": "application/json"}
                 ) as response:
+                    FlightRecorder.record("query_submit", http=response.status)
                     if response.status == 200:
                         result = await response.json()
                         query_session_id = result.get('session_id')
@@ -360,47 +1051,74 @@ class Main(Star):
                         error_text = await response.text()
                         logger.error(f"提交查询失败: {response.status} - {error_text}")
                         return None
+        except DeadlineExceeded:
+            raise
+        except asyncio.TimeoutError:
+            deadline.check("提交问题")
+            logger.error(f"提交查询请求超时: 超过单次请求超时 {self.timeout}秒")
+            return None
         except Exception as e:
             logger.error(f"提交查询请求失败: {e}")
             return None
     
-    async def _poll_query_result(self, query_session_id: str, event: AstrMessageEvent) -> Optional[str]:
-        """轮询查询结果"""
+    async def _poll_query_result(self, query_session_id: str, event: Optional[AstrMessageEvent] = None,
+                                 analysis_session_id: Optional[str] = None,
+                                 deadline: Optional["Deadline"] = None) -> Optional[str]:
+        """轮询查询结果，传入 analysis_session_id 时将检索到的上下文写入本地索引"""
+        deadline = deadline or Deadline(self.query_timeout)
+        stage = "查询轮询"
         try:
             logger.info(f"开始轮询查询结果: {query_session_id}")
-            async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=self.query_timeout)) as session:
-                max_polls = 180  # 最多轮询3分钟 (180 * 2秒)
+            async with aiohttp.ClientSession(headers=FlightRecorder.headers()) as session:
                 poll_count = 0
+                last_status = None
                 
-                while poll_count < max_polls:
+                while True:
                     poll_count += 1
                     # 先检查状态
-                    logger.info(f"轮询第 {poll_count} 次，查询状态: {query_session_id}")
+                    logger.info(f"轮询第 {poll_count} 次，查询状态: {query_session_id}，剩余预算 {deadline.remaining():.0f}秒")
                     
                     async with session.get(
-                        f"{self.api_base_url}/api/v1/repos/query/status/{query_session_id}"
+                        f"{self.api_base_url}/api/v1/repos/query/status/{query_session_id}",
+                        timeout=deadline.http_timeout(stage, self.timeout)
                     ) as response:
                         if response.status == 200:
                             status_result = await response.json()
                             status = status_result.get('status')
                             logger.info(f"查询状态: {status}, session_id: {query_session_id}")
+                            if status != last_status:
+                                FlightRecorder.record("query_status", status=status, poll=poll_count)
+                                last_status = status
                             
                             if status == 'success':
                                 # 获取结果
                                 logger.info(f"查询成功，获取结果: {query_session_id}")
+                                stage = "获取结果"
                                 async with session.get(
-                                    f"{self.api_base_url}/api/v1/repos/query/result/{query_session_id}"
+                                    f"{self.api_base_url}/api/v1/repos/query/result/{query_session_id}",
+                                    timeout=deadline.http_timeout(stage, self.timeout)
                                 ) as result_response:
+                                    FlightRecorder.record("result_fetch", http=result_response.status)
                                     if result_response.status == 200:
                                         result = await result_response.json()
                                         logger.info(f"获取结果成功: {len(str(result))} 字符")
                                         
+                                        if self.chunk_index and analysis_session_id and result.get('retrieved_context'):
+                                            added = await self.chunk_index.add_chunks(analysis_session_id, result['retrieved_context'])
+                                            FlightRecorder.record("local_index_add", chunks=added)
+                                        
                                         # 如果是plugin模式，需要自己生成答案
                                         if result.get('generation_mode') == 'plugin':
+                                            FlightRecorder.record("generation_start", chunks=len(result.get('retrieved_context', [])))
                                             answer = await self._generate_answer_from_context(
                                                 result.get('retrieved_context', []),
-                                                result.get('question', '')
+                                                result.get('question', ''),
+                                                deadline
                                             )
+                                            if not answer:
+                                                FlightRecorder.record("generation_failed")
+                                                return None
+                                            FlightRecorder.record("generation_done", chars=len(answer))
                                             logger.info(f"生成答案完成: {len(answer)} 字符")
                                             return answer
                                         else:
@@ -418,7 +1136,7 @@ class Main(Star):
                                 return None
                             elif status in ['queued', 'processing', 'started', 'pending']:
                                 logger.info(f"查询进行中: {status}")
-                                await asyncio.sleep(2)  # 查询轮询间隔更短
+                                await deadline.sleep(2, stage)  # 查询轮询间隔更短
                                 continue
                             else:
                                 logger.error(f"未知查询状态: {status}")
@@ -429,13 +1147,36 @@ class Main(Star):
                             logger.error(f"错误详情: {error_text}")
                             return None
                 
-                logger.error(f"查询超时: 已轮询 {max_polls} 次，session_id: {query_session_id}")
-                return None
-                
+        except DeadlineExceeded:
+            raise
+        except asyncio.TimeoutError:
+            deadline.check(stage)
+            logger.error(f"{stage}请求超时: 超过单次请求超时 {self.timeout}秒")
+            return None
         except Exception as e:
             logger.error(f"轮询查询结果失败: {e}")
             return None
     
+    async def _answer_from_local_index(self, analysis_session_id: str, question: str,
+                                       deadline: Optional["Deadline"] = None) -> Optional[str]:
+        """用本地索引中的片段和 AstrBot 的 LLM 回答问题，覆盖不足或生成失败时返回 None"""
+        if not self.chunk_index:
+            return None
+        chunks = await self.chunk_index.search(analysis_session_id, question)
+        if not chunks:
+            self.metrics.incr("local_index.miss")
+            FlightRecorder.record("local_index_miss")
+            return None
+        
+        self.metrics.incr("local_index.hit")
+        FlightRecorder.record("local_index_hit", chunks=len(chunks))
+        answer = await self._generate_answer_from_context(chunks, question, deadline)
+        if not answer:
+            self.metrics.incr("local_index.generation_error")
+            return None
+        FlightRecorder.record("generation_done", chars=len(answer))
+        return answer
+    
     async def _send_long_message(self, event: AstrMessageEvent, message: str, max_length: int = 1500):
         """智能分段发送长消息，确保完整性和内容不丢失"""
         
@@ -447,6 +1188,7 @@ class Main(Star):
         if len(message) <= max_length:
             logger.info(f"消息无需分割，直接发送")
             await event.send(event.plain_result(message))
+            FlightRecorder.record("send", part=1, chars=len(message))
             logger.info(f"=== 消息发送完成 ===")
             return
         
@@ -589,6 +1331,7 @@ class Main(Star):
             logger.info(f"第{i+1}段发送内容预览: {final_part[:150]}..." if len(final_part) > 150 else f"第{i+1}段发送内容: {final_part}")
             
             await event.send(event.plain_result(final_part))
+            FlightRecorder.record("send", part=i + 1, chars=len(final_part))
             logger.info(f"✅ 第{i+1}段发送成功")
             
             # 在多段消息之间稍作延迟，避免消息顺序混乱
@@ -599,8 +1342,10 @@ class Main(Star):
         logger.info(f"=== 所有消息发送完成 ===")
         logger.info(f"总计发送 {len(parts)} 段消息，原始消息 {len(message)} 字符已完整传递")
     
-    async def _generate_answer_from_context(self, context_list: list, question: str) -> str:
-        """基于检索到的上下文生成答案"""
+    async def _generate_answer_from_context(self, context_list: list, question: str,
+                                            deadline: Optional["Deadline"] = None) -> Optional[str]:
+        """基于检索到的上下文生成答案，LLM 调用失败时返回 None 以便计入生成错误率"""
+        deadline = deadline or Deadline(self.query_timeout)
         try:
             if not context_list:
                 return "抱歉，没有找到相关的代码信息来回答您的问题。"
@@ -624,23 +1369,28 @@ class Main(Star):
             # 使用AstrBot的LLM功能生成答案
             provider = self.context.get_using_provider()
             if provider:
-                response = await provider.text_chat(
+                response = await deadline.run(provider.text_chat(
                     prompt=prompt,
                     session_id=None,
                     contexts=[],
                     image_urls=[],
                     system_prompt="你是一个专业的代码分析助手，能够基于提供的代码上下文回答用户的问题。"
-                )
-                return response.completion_text if response else "生成答案失败"
+                ), "生成答案")
+                if not response or not response.completion_text:
+                    logger.error("生成答案失败: LLM 返回为空")
+                    return None
+                return response.completion_text
             else:
                 # 如果没有配置LLM，返回简单的上下文摘要
                 return f"找到了 {len(context_list)} 个相关代码片段：\n\n" + "\n\n".join([
                     f"📁 {ctx.get('file_path', 'Unknown')}\n{ctx.get('content', '')[:200]}..."
                     for ctx in context_list[:3]
                 ])
+        except DeadlineExceeded:
+            raise
         except Exception as e:
             logger.error(f"生成答案失败: {e}")
-            return f"生成答案时出错: {str(e)}"
+            return None
     
     @filter.command("repo_test")
     async def test_plugin(self, event: AstrMessageEvent):
@@ -652,26 +1402,212 @@ class Main(Star):
             logger.error(f"测试命令失败: {e}")
             yield event.plain_result(f"❌ 测试失败: {str(e)}")
     
+    @filter.command("repo_batch")
+    async def repo_batch(self, event: AstrMessageEvent):
+        """批量分析仓库：/repo_batch <仓库URL...> 或 /repo_batch <用户名/组织名>，/repo_batch 取消 停止当前批次"""
+        try:
+            user_id = event.unified_msg_origin
+            batch_key = f"batch:{user_id}"
+            args = [arg for arg in re.split(r"[\s,，]+", event.message_str.strip()) if arg]
+            if args and args[0].lstrip('/').lower() == "repo_batch":
+                args = args[1:]
+            running = any(job.kind == "batch" for job in self.job_tracker.active(batch_key))
+            
+            if not args:
+                progress = self._batches.get(user_id)
+                if progress:
+                    yield event.plain_result(progress.format(detail=True))
+                else:
+                    yield event.plain_result(
+                        "📦 **批量分析用法:**\n"
+                        "• /repo_batch <仓库URL> <仓库URL> ...\n"
+                        "• /repo_batch <GitHub 用户名或组织名>\n"
+                        "• /repo_batch 查看进度\n"
+                        "• /repo_batch 取消"
+                    )
+                return
+            
+            if args[0].lower() in ['取消', 'cancel', 'stop']:
+                if not running:
+                    yield event.plain_result("当前没有进行中的批量分析")
+                    return
+                await self.job_tracker.cancel_user(batch_key, "cancel")
+                yield event.plain_result("🛑 已取消批量分析，已完成的仓库仍可在 /repo_qa 中直接使用")
+                return
+            
+            if running:
+                yield event.plain_result("⚠️ 您已有一个批量分析在进行中，发送 /repo_batch 查看进度，或 /repo_batch 取消 停止当前批次")
+                return
+            
+            repo_urls = [arg.rstrip('/') for arg in args if self._is_valid_github_url(arg)]
+            others = [arg for arg in args if not self._is_valid_github_url(arg)]
+            if others:
+                owner_match = re.match(r'^(?:https://github\.com/)?([A-Za-z0-9][A-Za-z0-9-]*)/?$', others[0])
+                if repo_urls or len(others) > 1 or not owner_match:
+                    yield event.plain_result(
+                        f"❌ 无法识别: {' '.join(others)}\n\n"
+                        "请发送多个仓库URL（如 https://github.com/user/repo），或单个用户名/组织名"
+                    )
+                    return
+                owner = owner_match.group(1)
+                yield event.plain_result(f"🔍 正在获取 {owner} 的仓库列表...")
+                repo_urls = await self._list_owner_repositories(owner)
+                if repo_urls is None:
+                    yield event.plain_result(f"❌ 获取 {owner} 的仓库列表失败，请稍后重试")
+                    return
+            
+            repo_urls = list(dict.fromkeys(repo_urls))
+            if not repo_urls:
+                yield event.plain_result("❌ 没有找到可分析的仓库")
+                return
+            skipped = len(repo_urls) - self.batch_max_repos
+            repo_urls = repo_urls[:self.batch_max_repos]
+            
+            progress = BatchProgress(repo_urls)
+            self._batches[user_id] = progress
+            self.job_tracker.start(batch_key, "batch", self._run_batch(user_id, progress))
+            logger.info(f"开始批量分析: {user_id}，共 {len(repo_urls)} 个仓库")
+            
+            message = f"📦 开始批量分析 {len(repo_urls)} 个仓库（并发 {self.batch_concurrency}）"
+            if skipped > 0:
+                message += f"\n⚠️ 超出单批上限 {self.batch_max_repos}，已跳过 {skipped} 个仓库"
+            message += "\n\n完成后会通知您，期间可发送 /repo_batch 查看进度"
+            yield event.plain_result(message)
+        except Exception as e:
+            logger.error(f"批量分析命令失败: {e}")
+            yield event.plain_result(f"❌ 批量分析失败: {str(e)}")
+    
     @filter.command("repo_status")
-    async def check_repo_status(self, event: AstrMessageEvent):
-        """查看当前用户的仓库分析状态"""
+    async def check_repo_status(self, event: AstrMessageEvent, page: int = 1):
+        """查看当前用户的仓库分析状态，支持分页：/repo_status [页码]"""
         try:
-            tasks = await self.state_manager.get_user_tasks(event.unified_msg_origin)
-            if not tasks:
-                yield event.plain_result("📋 您当前没有进行中的仓库分析任务")
+            user_origin = event.unified_msg_origin
+            total = await self.state_manager.count_user_tasks(user_origin)
+            if not total:
+                yield event.plain_result("📋 您当前没有仓库分析任务记录")
                 return
             
-            status_text = "📊 **您的仓库分析状态:**\n\n"
+            page_size = max(1, self.status_page_size)
+            total_pages = (total + page_size - 1) // page_size
+            page = min(max(1, page), total_pages)
+            tasks = await self.state_manager.get_user_tasks(
+                user_origin, limit=page_size, offset=(page - 1) * page_size
+            )
+            
+            status_labels = {
+                TASK_STATUS_PENDING: "⏳ 排队中",
+                TASK_STATUS_PROCESSING: "🔄 分析中",
+                TASK_STATUS_SUCCESS: "✅ 已完成",
+                TASK_STATUS_FAILED: "❌ 失败",
+                TASK_STATUS_CANCELLED: "🚫 已取消",
+                TASK_STATUS_UNKNOWN: "❔ 结果未知",
+            }
+            
+            status_text = f"📊 **您的仓库分析状态** (第 {page}/{total_pages} 页，共 {total} 条):\n\n"
             for task in tasks:
                 status_text += f"• 仓库: {task['repo_url']}\n"
+                status_text += f"  状态: {status_labels.get(task['status'], task['status'])}\n"
                 status_text += f"  会话ID: {task['session_id']}\n"
-                status_text += f"  创建时间: {task['created_at']}\n\n"
+                status_text += f"  创建时间: {task['created_at']}\n"
+                if task['duration_seconds'] is not None:
+                    status_text += f"  耗时: {task['duration_seconds']:.1f}秒\n"
+                if task['error_message']:
+                    status_text += f"  错误: {task['error_message']}\n"
+                status_text += "\n"
+            
+            if page < total_pages:
+                status_text += f"💡 发送 /repo_status {page + 1} 查看下一页"
             
             yield event.plain_result(status_text)
         except Exception as e:
             logger.error(f"查看状态失败: {e}")
             yield event.plain_result(f"❌ 查看状态失败: {str(e)}")
     
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("repo_traces")
+    async def show_slow_traces(self, event: AstrMessageEvent, kind: str = "", count: int = 5):
+        """查看最近最慢的请求时间线（管理员）：/repo_traces [类型] [条数]，类型如 question、analysis、batch"""
+        try:
+            # 兼容只传条数的用法：/repo_traces 10
+            if kind.isdigit():
+                kind, count = "", int(kind)
+            traces = self.flight_recorder.slowest(max(1, count), kind or None)
+            if not traces:
+                yield event.plain_result("📋 暂无已完成的请求追踪记录")
+                return
+            
+            kind_text = f" {kind} " if kind else "的 "
+            trace_text = f"🐢 **最近最慢{kind_text}{len(traces)} 个请求:**\n\n"
+            trace_text += "\n\n".join(trace.format() for trace in traces)
+            yield event.plain_result(trace_text)
+        except Exception as e:
+            logger.error(f"查看请求追踪失败: {e}")
+            yield event.plain_result(f"❌ 查看请求追踪失败: {str(e)}")
+    
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("repo_metrics")
+    async def show_metrics(self, event: AstrMessageEvent):
+        """查看插件运行指标（管理员）"""
+        try:
+            metrics_text = self.metrics.format()
+            if not metrics_text:
+                yield event.plain_result("📋 暂无运行指标")
+                return
+            yield event.plain_result(f"📈 **RepoInsight 运行指标:**\n\n{metrics_text}")
+        except Exception as e:
+            logger.error(f"查看运行指标失败: {e}")
+            yield event.plain_result(f"❌ 查看运行指标失败: {str(e)}")
+    
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("repo_export")
+    async def export_snapshot(self, event: AstrMessageEvent, path: str = ""):
+        """导出已分析仓库和答案缓存的快照（管理员）：/repo_export [路径]"""
+        try:
+            path = path or self.snapshot_path
+            started = time.monotonic()
+            counts = await CacheSnapshot(self.state_manager).export(path, self.instance_id)
+            size_kb = os.path.getsize(path) / 1024
+            logger.info(f"已导出缓存快照 {path}: 仓库 {counts['analyses']} 个，答案 {counts['answers']} 条")
+            yield event.plain_result(
+                f"✅ 缓存快照已导出\n\n"
+                f"• 文件: {path}（{size_kb:.1f} KB）\n"
+                f"• 已分析仓库: {counts['analyses']} 个\n"
+                f"• 缓存答案: {counts['answers']} 条\n"
+                f"• 耗时: {time.monotonic() - started:.1f}秒"
+            )
+        except Exception as e:
+            logger.error(f"导出缓存快照失败: {e}")
+            yield event.plain_result(f"❌ 导出缓存快照失败: {str(e)}")
+    
+    @filter.permission_type(filter.PermissionType.ADMIN)
+    @filter.command("repo_import")
+    async def import_snapshot(self, event: AstrMessageEvent, path: str = ""):
+        """导入已分析仓库和答案缓存的快照（管理员）：/repo_import [路径]"""
+        try:
+            path = path or self.snapshot_path
+            if not os.path.exists(path):
+                yield event.plain_result(f"❌ 快照文件不存在: {path}")
+                return
+            started = time.monotonic()
+            result = await CacheSnapshot(self.state_manager).load(path, self.analysis_cache_ttl, self.answer_cache_ttl)
+            logger.info(f"已导入缓存快照 {path}: 仓库 {result['analyses']} 个，答案 {result['answers']} 条")
+            message = (
+                f"✅ 缓存快照已导入\n\n"
+                f"• 文件: {path}\n"
+                f"• 已分析仓库: {result['analyses']} 个\n"
+                f"• 缓存答案: {result['answers']} 条\n"
+                f"• 跳过过期记录: {result['expired']} 条\n"
+                f"• 耗时: {time.monotonic() - started:.1f}秒"
+            )
+            if not result['complete']:
+                message += "\n\n⚠️ 快照文件不完整，仅导入了可读取的部分"
+            yield event.plain_result(message)
+        except SnapshotError as e:
+            yield event.plain_result(f"❌ {str(e)}")
+        except Exception as e:
+            logger.error(f"导入缓存快照失败: {e}")
+            yield event.plain_result(f"❌ 导入缓存快照失败: {str(e)}")
+    
     @filter.command("repo_config")
     async def show_config(self, event: AstrMessageEvent):
         """显示当前配置"""
@@ -680,9 +1616,11 @@ class Main(Star):
 
 **API 配置:**
 • 服务地址: {self.api_base_url}
-• 分析超时: {self.timeout}秒
-• 查询超时: {self.query_timeout}秒
+• 请求超时: {self.timeout}秒
+• 问题时间预算: {self.query_timeout}秒
+• 分析时间预算: {self.analysis_timeout}秒
 • 轮询间隔: {self.poll_interval}秒
+• 生成模式: {self.generation_mode}
 
 **Embedding 配置:**
 • 提供商: {self.embedding_config.get('provider', 'Unknown')}
@@ -702,64 +1640,299 @@ class Main(Star):
     async def terminate(self):
         """插件终止时的清理工作"""
         try:
+            for task in (self._retention_task, self._takeover_task):
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+            if self._snapshot_task:
+                self._snapshot_task.cancel()
+                try:
+                    await self._snapshot_task
+                except asyncio.CancelledError:
+                    pass
             await self.state_manager.close()
             logger.info("RepoInsight插件已清理完成")
         except Exception as e:
             logger.error(f"插件清理失败: {e}")
 
 
-class StateManager:
-    """状态持久化管理器"""
+# 分析完成后默认预取的常见问题
+DEFAULT_PREFETCH_QUESTIONS = [
+    "这个项目的主要功能是什么？",
+    "项目的整体架构是怎样的？",
+    "如何安装和运行这个项目？",
+    "项目的主要入口文件和核心模块有哪些？",
+]
+
+
+# 数据库结构迁移，按版本号顺序执行，已发布的版本不要修改
+SCHEMA_MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS analysis_tasks (
+            session_id TEXT PRIMARY KEY,
+            repo_url TEXT NOT NULL,
+            user_origin TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            status TEXT DEFAULT 'pending'
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS user_states (
+            user_id TEXT PRIMARY KEY,
+            current_repo_url TEXT,
+            analysis_session_id TEXT,
+            updated_at TEXT NOT NULL
+        )
+        """,
+    ]),
+    (2, [
+        "ALTER TABLE analysis_tasks ADD COLUMN started_at TEXT",
+        "ALTER TABLE analysis_tasks ADD COLUMN finished_at TEXT",
+        "ALTER TABLE analysis_tasks ADD COLUMN duration_seconds REAL",
+        "ALTER TABLE analysis_tasks ADD COLUMN error_message TEXT",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_user_created ON analysis_tasks (user_origin, created_at DESC)",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_status ON analysis_tasks (status)",
+        "CREATE INDEX IF NOT EXISTS idx_tasks_created ON analysis_tasks (created_at)",
+        """
+        CREATE TABLE IF NOT EXISTS analysis_tasks_archive (
+            session_id TEXT PRIMARY KEY,
+            repo_url TEXT NOT NULL,
+            user_origin TEXT NOT NULL,
+            created_at TEXT NOT NULL,
+            status TEXT,
+            started_at TEXT,
+            finished_at TEXT,
+            duration_seconds REAL,
+            error_message TEXT,
+            archived_at TEXT NOT NULL
+        )
+        """,
+    ]),
+    (3, [
+        # 切换为增量 VACUUM 模式，迁移结束后由 _migrate 执行一次完整 VACUUM 生效
+        "PRAGMA auto_vacuum = INCREMENTAL",
+    ]),
+    (4, [
+        """
+        CREATE TABLE IF NOT EXISTS analysis_registry (
+            repo_url TEXT PRIMARY KEY,
+            analysis_session_id TEXT NOT NULL,
+            analyzed_at REAL NOT NULL
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS answer_cache (
+            analysis_session_id TEXT NOT NULL,
+            question_key TEXT NOT NULL,
+            question TEXT NOT NULL,
+            answer TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (analysis_session_id, question_key)
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_answer_cache_created ON answer_cache (created_at)",
+        """
+        CREATE TABLE IF NOT EXISTS task_leases (
+            task_id TEXT PRIMARY KEY,
+            owner TEXT NOT NULL,
+            expires_at REAL NOT NULL
+        )
+        """,
+    ]),
+    (5, [
+        # 旧版本从不更新任务状态，升级前遗留的 pending 记录无从得知结果，
+        # 标记为结果未知，避免启动时被当作未完成任务恢复并通知用户
+        """
+        UPDATE analysis_tasks
+        SET status = 'unknown', finished_at = created_at, error_message = '插件升级前的任务，结果未知'
+        WHERE status = 'pending' AND started_at IS NULL
+        """,
+    ]),
+]
+
+# 任务状态生命周期
+TASK_STATUS_PENDING = 'pending'
+TASK_STATUS_PROCESSING = 'processing'
+TASK_STATUS_SUCCESS = 'success'
+TASK_STATUS_FAILED = 'failed'
+TASK_STATUS_CANCELLED = 'cancelled'
+TASK_STATUS_UNKNOWN = 'unknown'
+TASK_FINISHED_STATUSES = (TASK_STATUS_SUCCESS, TASK_STATUS_FAILED, TASK_STATUS_CANCELLED, TASK_STATUS_UNKNOWN)
+
+TASK_COLUMNS = (
+    "session_id, repo_url, user_origin, created_at, status, "
+    "started_at, finished_at, duration_seconds, error_message"
+)
+
+
+def normalize_question(question: str) -> str:
+    """归一化问题文本，用于缓存和去重"""
+    return " ".join(question.split()).lower()
+
+
+def question_key(question: str) -> str:
+    """问题归一化后的摘要，作为缓存键"""
+    return hashlib.sha1(normalize_question(question).encode("utf-8")).hexdigest()
+
+
+class StateBackend(ABC):
+    """状态存储后端接口
+
+    持久化用户状态、分析任务、已分析仓库登记、答案缓存和任务租约。
+    各方法自行处理存储异常并记录日志，不向调用方抛出；
+    快照使用的 iter_* / import_* 方法例外，异常交由调用方报告给管理员。
+    """
     
-    def __init__(self):
-        self.db_path = os.path.join("data", "repoinsight_tasks.db")
-        self._ensure_data_dir()
-        self._init_db_task = asyncio.create_task(self._init_db())
-        # 内存中的用户状态缓存
-        self.user_states = {}
+    async def init(self):
+        """初始化存储"""
     
-    def _ensure_data_dir(self):
-        """确保data目录存在"""
-        os.makedirs("data", exist_ok=True)
+    @abstractmethod
+    async def get_user_state(self, user_id: str) -> Optional[Dict[str, Any]]:
+        ...
     
-    async def _init_db(self):
-        """初始化数据库"""
+    @abstractmethod
+    async def set_user_state(self, user_id: str, current_repo_url: Optional[str], analysis_session_id: Optional[str]):
+        ...
+    
+    @abstractmethod
+    async def clear_user_state(self, user_id: str):
+        ...
+    
+    @abstractmethod
+    async def add_task(self, session_id: str, repo_url: str, user_origin: str):
+        ...
+    
+    @abstractmethod
+    async def update_task_status(self, session_id: str, status: str, error_message: Optional[str] = None):
+        ...
+    
+    @abstractmethod
+    async def remove_task(self, session_id: str):
+        ...
+    
+    @abstractmethod
+    async def get_all_pending_tasks(self) -> list:
+        ...
+    
+    @abstractmethod
+    async def get_user_tasks(self, user_origin: str, limit: int, offset: int) -> list:
+        ...
+    
+    @abstractmethod
+    async def count_user_tasks(self, user_origin: str) -> int:
+        ...
+    
+    @abstractmethod
+    async def purge_old_tasks(self, retention_days: int, archive: bool = True, vacuum_pages: int = 0,
+                              archive_retention_days: int = 90, answer_cache_ttl: float = 86400) -> int:
+        ...
+    
+    @abstractmethod
+    async def register_analysis(self, repo_url: str, analysis_session_id: str):
+        ...
+    
+    @abstractmethod
+    async def get_analysis(self, repo_url: str, max_age: float) -> Optional[str]:
+        ...
+    
+    @abstractmethod
+    async def get_cached_answer(self, analysis_session_id: str, question: str, max_age: float) -> Optional[str]:
+        ...
+    
+    @abstractmethod
+    async def cache_answer(self, analysis_session_id: str, question: str, answer: str, ttl: float):
+        ...
+    
+    @abstractmethod
+    def iter_analyses(self, batch_size: int) -> AsyncIterator[list]:
+        """按批产出已分析仓库登记，每条包含 repo_url、analysis_session_id、analyzed_at"""
+    
+    @abstractmethod
+    def iter_cached_answers(self, batch_size: int) -> AsyncIterator[list]:
+        """按批产出答案缓存，每条包含 analysis_session_id、question、answer、created_at"""
+    
+    @abstractmethod
+    async def import_analyses(self, records: list) -> int:
+        """导入已分析仓库登记，只覆盖更旧的记录，返回实际写入条数"""
+    
+    @abstractmethod
+    async def import_cached_answers(self, records: list, ttl: float) -> int:
+        """导入答案缓存，只覆盖更旧的记录，返回实际写入条数"""
+    
+    @abstractmethod
+    async def acquire_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """获取任务租约，租约已被其他实例持有且未过期时返回 False"""
+    
+    @abstractmethod
+    async def renew_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """续期自己持有的租约，租约已丢失时返回 False；存储出错时抛出异常，由调用方重试"""
+    
+    @abstractmethod
+    async def release_lease(self, task_id: str, owner: str):
+        ...
+    
+    async def close(self):
+        """关闭存储连接"""
+
+
+class SQLiteStateBackend(StateBackend):
+    """基于本地 SQLite 文件的存储后端"""
+    
+    def __init__(self, db_path: str = os.path.join("data", "repoinsight_tasks.db")):
+        self.db_path = db_path
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+    
+    async def init(self):
+        """初始化数据库并执行结构迁移"""
         try:
             async with aiosqlite.connect(self.db_path) as db:
-                # 分析任务表
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS analysis_tasks (
-                        session_id TEXT PRIMARY KEY,
-                        repo_url TEXT NOT NULL,
-                        user_origin TEXT NOT NULL,
-                        created_at TEXT NOT NULL,
-                        status TEXT DEFAULT 'pending'
-                    )
-                """)
-                # 用户状态表
-                await db.execute("""
-                    CREATE TABLE IF NOT EXISTS user_states (
-                        user_id TEXT PRIMARY KEY,
-                        current_repo_url TEXT,
-                        analysis_session_id TEXT,
-                        updated_at TEXT NOT NULL
-                    )
-                """)
-                await db.commit()
+                await self._migrate(db)
         except ImportError:
             logger.warning("aiosqlite未安装，状态持久化功能将不可用")
         except Exception as e:
             logger.error(f"初始化数据库失败: {e}")
+
+    async def _migrate(self, db):
+        """按版本号依次执行尚未应用的迁移"""
+        await db.execute("""
+            CREATE TABLE IF NOT EXISTS schema_version (
+                version INTEGER PRIMARY KEY,
+                applied_at TEXT NOT NULL
+            )
+        """)
+        await db.commit()
+
+        for version, statements in SCHEMA_MIGRATIONS:
+            # 每个版本在独占写事务中检查并执行，多个实例共用同一数据库文件时不会重复迁移
+            await db.execute("BEGIN IMMEDIATE")
+            cursor = await db.execute("SELECT MAX(version) FROM schema_version")
+            row = await cursor.fetchone()
+            current_version = row[0] or 0
+            if version <= current_version:
+                await db.rollback()
+                continue
+            logger.info(f"执行数据库迁移: v{current_version} -> v{version}")
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute(
+                "INSERT INTO schema_version (version, applied_at) VALUES (?, ?)",
+                (version, datetime.now().isoformat())
+            )
+            await db.commit()
+
+        # auto_vacuum 模式变更需要一次完整 VACUUM 才能生效，VACUUM 不能在事务中执行
+        cursor = await db.execute("PRAGMA auto_vacuum")
+        row = await cursor.fetchone()
+        if row and row[0] != 2:
+            await db.execute("PRAGMA auto_vacuum = INCREMENTAL")
+            await db.execute("VACUUM")
     
-    async def get_user_state(self, user_id: str) -> Dict[str, Any]:
+    async def get_user_state(self, user_id: str) -> Optional[Dict[str, Any]]:
         """获取用户状态"""
-        # 首先检查内存缓存
-        if user_id in self.user_states:
-            return self.user_states[user_id]
-        
-        # 从数据库读取
         try:
-            await self._init_db_task
             async with aiosqlite.connect(self.db_path) as db:
                 cursor = await db.execute(
                     "SELECT current_repo_url, analysis_session_id FROM user_states WHERE user_id = ?",
@@ -767,33 +1940,14 @@ class StateManager:
                 )
                 row = await cursor.fetchone()
                 if row:
-                    state = {
-                        'current_repo_url': row[0],
-                        'analysis_session_id': row[1],
-                        'processing_questions': set()
-                    }
-                    self.user_states[user_id] = state
-                    return state
+                    return {'current_repo_url': row[0], 'analysis_session_id': row[1]}
         except Exception as e:
             logger.error(f"获取用户状态失败: {e}")
-        
-        # 返回默认状态
-        default_state = {
-            'current_repo_url': None,
-            'analysis_session_id': None,
-            'processing_questions': set()
-        }
-        self.user_states[user_id] = default_state
-        return default_state
+        return None
     
-    async def set_user_state(self, user_id: str, state: Dict[str, Any]):
+    async def set_user_state(self, user_id: str, current_repo_url: Optional[str], analysis_session_id: Optional[str]):
         """设置用户状态"""
-        # 更新内存缓存
-        self.user_states[user_id] = state
-        
-        # 保存到数据库
         try:
-            await self._init_db_task
             async with aiosqlite.connect(self.db_path) as db:
                 await db.execute("""
                     INSERT OR REPLACE INTO user_states 
@@ -801,8 +1955,8 @@ class StateManager:
                     VALUES (?, ?, ?, ?)
                 """, (
                     user_id,
-                    state.get('current_repo_url'),
-                    state.get('analysis_session_id'),
+                    current_repo_url,
+                    analysis_session_id,
                     datetime.now().isoformat()
                 ))
                 await db.commit()
@@ -811,12 +1965,7 @@ class StateManager:
     
     async def clear_user_state(self, user_id: str):
         """清除用户状态"""
-        # 清除内存缓存
-        self.user_states.pop(user_id, None)
-        
-        # 从数据库删除
         try:
-            await self._init_db_task
             async with aiosqlite.connect(self.db_path) as db:
                 await db.execute("DELETE FROM user_states WHERE user_id = ?", (user_id,))
                 await db.commit()
@@ -826,11 +1975,10 @@ class StateManager:
     async def add_task(self, session_id: str, repo_url: str, user_origin: str):
         """添加分析任务"""
         try:
-            await self._init_db_task  # 等待数据库初始化完成
             async with aiosqlite.connect(self.db_path) as db:
                 await db.execute(
-                    "INSERT OR REPLACE INTO analysis_tasks (session_id, repo_url, user_origin, created_at) VALUES (?, ?, ?, ?)",
-                    (session_id, repo_url, user_origin, datetime.now().isoformat())
+                    "INSERT OR REPLACE INTO analysis_tasks (session_id, repo_url, user_origin, created_at, status) VALUES (?, ?, ?, ?, ?)",
+                    (session_id, repo_url, user_origin, datetime.now().isoformat(), TASK_STATUS_PENDING)
                 )
                 await db.commit()
         except ImportError:
@@ -838,71 +1986,1603 @@ class StateManager:
         except Exception as e:
             logger.error(f"添加任务失败: {e}")
     
-    async def remove_task(self, session_id: str):
-        """移除分析任务"""
+    async def update_task_status(self, session_id: str, status: str, error_message: Optional[str] = None):
+        """更新任务状态，并记录开始/结束时间和耗时"""
         try:
-            await self._init_db_task
+            now = datetime.now()
             async with aiosqlite.connect(self.db_path) as db:
-                await db.execute("DELETE FROM analysis_tasks WHERE session_id = ?", (session_id,))
-                await db.commit()
-        except ImportError:
-            pass
+                if status == TASK_STATUS_PROCESSING:
+                    await db.execute(
+                        "UPDATE analysis_tasks SET status = ?, started_at = COALESCE(started_at, ?) WHERE session_id = ?",
+                        (status, now.isoformat(), session_id)
+                    )
+                elif status in TASK_FINISHED_STATUSES:
+                    cursor = await db.execute(
+                        "SELECT COALESCE(started_at, created_at) FROM analysis_tasks WHERE session_id = ?",
+                        (session_id,)
+                    )
+                    row = await cursor.fetchone()
+                    duration = None
+                    if row and row[0]:
+                        duration = (now - datetime.fromisoformat(row[0])).total_seconds()
+                    await db.execute(
+                        "UPDATE analysis_tasks SET status = ?, finished_at = ?, duration_seconds = ?, error_message = ? WHERE session_id = ?",
+                        (status, now.isoformat(), duration, error_message, session_id)
+                    )
+                else:
+                    await db.execute(
+                        "UPDATE analysis_tasks SET status = ? WHERE session_id = ?",
+                        (status, session_id)
+                    )
+                await db.commit()
+        except ImportError:
+            pass
+        except Exception as e:
+            logger.error(f"更新任务状态失败: {e}")
+    
+    async def remove_task(self, session_id: str):
+        """移除分析任务"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute("DELETE FROM analysis_tasks WHERE session_id = ?", (session_id,))
+                await db.commit()
+        except ImportError:
+            pass
         except Exception as e:
             logger.error(f"移除任务失败: {e}")
     
-    async def get_all_pending_tasks(self):
-        """获取所有待处理任务"""
+    @staticmethod
+    def _row_to_task(row) -> Dict[str, Any]:
+        """将 TASK_COLUMNS 顺序的查询结果转换为字典"""
+        return {
+            'session_id': row[0],
+            'repo_url': row[1],
+            'user_origin': row[2],
+            'created_at': row[3],
+            'status': row[4],
+            'started_at': row[5],
+            'finished_at': row[6],
+            'duration_seconds': row[7],
+            'error_message': row[8]
+        }
+    
+    async def get_all_pending_tasks(self) -> list:
+        """获取所有未完成（排队中或处理中）的任务"""
         try:
-            await self._init_db_task
             async with aiosqlite.connect(self.db_path) as db:
-                cursor = await db.execute("SELECT * FROM analysis_tasks WHERE status = 'pending'")
+                cursor = await db.execute(
+                    f"SELECT {TASK_COLUMNS} FROM analysis_tasks WHERE status IN (?, ?)",
+                    (TASK_STATUS_PENDING, TASK_STATUS_PROCESSING)
+                )
                 rows = await cursor.fetchall()
-                return [
-                    {
-                        'session_id': row[0],
-                        'repo_url': row[1],
-                        'user_origin': row[2],
-                        'created_at': row[3],
-                        'status': row[4]
-                    }
-                    for row in rows
-                ]
+                return [self._row_to_task(row) for row in rows]
         except ImportError:
             return []
         except Exception as e:
             logger.error(f"获取待处理任务失败: {e}")
             return []
     
-    async def get_user_tasks(self, user_origin: str):
-        """获取用户的所有任务"""
+    async def get_user_tasks(self, user_origin: str, limit: int, offset: int) -> list:
+        """分页获取用户的任务，按创建时间倒序"""
         try:
-            await self._init_db_task
             async with aiosqlite.connect(self.db_path) as db:
                 cursor = await db.execute(
-                    "SELECT * FROM analysis_tasks WHERE user_origin = ? ORDER BY created_at DESC",
-                    (user_origin,)
+                    f"SELECT {TASK_COLUMNS} FROM analysis_tasks WHERE user_origin = ? ORDER BY created_at DESC LIMIT ? OFFSET ?",
+                    (user_origin, limit, offset)
                 )
                 rows = await cursor.fetchall()
-                return [
-                    {
-                        'session_id': row[0],
-                        'repo_url': row[1],
-                        'user_origin': row[2],
-                        'created_at': row[3],
-                        'status': row[4]
-                    }
-                    for row in rows
-                ]
+                return [self._row_to_task(row) for row in rows]
+        except ImportError:
+            return []
+        except Exception as e:
+            logger.error(f"获取用户任务失败: {e}")
+            return []
+    
+    async def count_user_tasks(self, user_origin: str) -> int:
+        """统计用户的任务总数"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "SELECT COUNT(*) FROM analysis_tasks WHERE user_origin = ?",
+                    (user_origin,)
+                )
+                row = await cursor.fetchone()
+                return row[0] if row else 0
+        except ImportError:
+            return 0
+        except Exception as e:
+            logger.error(f"统计用户任务失败: {e}")
+            return 0
+    
+    async def purge_old_tasks(self, retention_days: int, archive: bool = True, vacuum_pages: int = 0,
+                              archive_retention_days: int = 90, answer_cache_ttl: float = 86400) -> int:
+        """清理超过保留期的任务和过期答案缓存，可选归档，并执行增量 VACUUM
+
+        已结束的任务按结束时间计算，长时间未结束的任务按创建时间计算；
+        归档记录超过 archive_retention_days 后删除，为 0 时永久保留。
+        返回清理的任务行数。
+        """
+        try:
+            cutoff = (datetime.now() - timedelta(days=retention_days)).isoformat()
+            condition = "COALESCE(finished_at, created_at) < ?"
+            async with aiosqlite.connect(self.db_path) as db:
+                if archive:
+                    await db.execute(
+                        f"INSERT OR REPLACE INTO analysis_tasks_archive ({TASK_COLUMNS}, archived_at) "
+                        f"SELECT {TASK_COLUMNS}, ? FROM analysis_tasks WHERE {condition}",
+                        (datetime.now().isoformat(), cutoff)
+                    )
+                cursor = await db.execute(f"DELETE FROM analysis_tasks WHERE {condition}", (cutoff,))
+                purged = cursor.rowcount
+                if archive_retention_days:
+                    await db.execute(
+                        "DELETE FROM analysis_tasks_archive WHERE archived_at < ?",
+                        ((datetime.now() - timedelta(days=archive_retention_days)).isoformat(),)
+                    )
+                await db.execute(
+                    "DELETE FROM answer_cache WHERE created_at < ?",
+                    (time.time() - answer_cache_ttl,)
+                )
+                await db.execute("DELETE FROM task_leases WHERE expires_at < ?", (time.time(),))
+                await db.commit()
+                
+                # 归还空闲页，vacuum_pages 为 0 时释放全部空闲页
+                # 该 PRAGMA 每次 step 只释放一页，需用 executescript 执行到底
+                pages = f"({int(vacuum_pages)})" if vacuum_pages else ""
+                await db.executescript(f"PRAGMA incremental_vacuum{pages};")
+                return purged
         except ImportError:
+            return 0
+        except Exception as e:
+            logger.error(f"清理过期任务失败: {e}")
+            return 0
+    
+    async def register_analysis(self, repo_url: str, analysis_session_id: str):
+        """登记已分析完成的仓库"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    "INSERT OR REPLACE INTO analysis_registry (repo_url, analysis_session_id, analyzed_at) VALUES (?, ?, ?)",
+                    (repo_url, analysis_session_id, time.time())
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"登记已分析仓库失败: {e}")
+    
+    async def get_analysis(self, repo_url: str, max_age: float) -> Optional[str]:
+        """查找未过期的仓库分析会话ID"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "SELECT analysis_session_id FROM analysis_registry WHERE repo_url = ? AND analyzed_at >= ?",
+                    (repo_url, time.time() - max_age)
+                )
+                row = await cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logger.error(f"查询已分析仓库失败: {e}")
+            return None
+    
+    async def get_cached_answer(self, analysis_session_id: str, question: str, max_age: float) -> Optional[str]:
+        """查找未过期的缓存答案"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute(
+                    "SELECT answer FROM answer_cache WHERE analysis_session_id = ? AND question_key = ? AND created_at >= ?",
+                    (analysis_session_id, question_key(question), time.time() - max_age)
+                )
+                row = await cursor.fetchone()
+                return row[0] if row else None
+        except Exception as e:
+            logger.error(f"查询答案缓存失败: {e}")
+            return None
+    
+    async def cache_answer(self, analysis_session_id: str, question: str, answer: str, ttl: float):
+        """写入答案缓存，过期由 get_cached_answer 的 max_age 和定期清理控制"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    "INSERT OR REPLACE INTO answer_cache (analysis_session_id, question_key, question, answer, created_at) VALUES (?, ?, ?, ?, ?)",
+                    (analysis_session_id, question_key(question), question, answer, time.time())
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"写入答案缓存失败: {e}")
+    
+    async def iter_analyses(self, batch_size: int):
+        """按批读取已分析仓库登记"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                "SELECT repo_url, analysis_session_id, analyzed_at FROM analysis_registry"
+            ) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [dict(row) for row in rows]
+    
+    async def iter_cached_answers(self, batch_size: int):
+        """按批读取答案缓存"""
+        async with aiosqlite.connect(self.db_path) as db:
+            db.row_factory = aiosqlite.Row
+            async with db.execute(
+                "SELECT analysis_session_id, question, answer, created_at FROM answer_cache"
+            ) as cursor:
+                while True:
+                    rows = await cursor.fetchmany(batch_size)
+                    if not rows:
+                        break
+                    yield [dict(row) for row in rows]
+    
+    async def import_analyses(self, records: list) -> int:
+        """批量导入已分析仓库登记，本地记录更新时保留本地记录"""
+        async with aiosqlite.connect(self.db_path) as db:
+            before = db.total_changes
+            await db.executemany(
+                """
+                INSERT INTO analysis_registry (repo_url, analysis_session_id, analyzed_at) VALUES (?, ?, ?)
+                ON CONFLICT(repo_url) DO UPDATE SET
+                    analysis_session_id = excluded.analysis_session_id,
+                    analyzed_at = excluded.analyzed_at
+                WHERE excluded.analyzed_at > analysis_registry.analyzed_at
+                """,
+                [(r['repo_url'], r['analysis_session_id'], r['analyzed_at']) for r in records]
+            )
+            await db.commit()
+            return db.total_changes - before
+    
+    async def import_cached_answers(self, records: list, ttl: float) -> int:
+        """批量导入答案缓存，本地记录更新时保留本地记录"""
+        async with aiosqlite.connect(self.db_path) as db:
+            before = db.total_changes
+            await db.executemany(
+                """
+                INSERT INTO answer_cache (analysis_session_id, question_key, question, answer, created_at) VALUES (?, ?, ?, ?, ?)
+                ON CONFLICT(analysis_session_id, question_key) DO UPDATE SET
+                    question = excluded.question,
+                    answer = excluded.answer,
+                    created_at = excluded.created_at
+                WHERE excluded.created_at > answer_cache.created_at
+                """,
+                [
+                    (r['analysis_session_id'], question_key(r['question']), r['question'], r['answer'], r['created_at'])
+                    for r in records
+                ]
+            )
+            await db.commit()
+            return db.total_changes - before
+    
+    async def acquire_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """获取任务租约，同一数据库文件上的多个实例之间互斥"""
+        try:
+            now = time.time()
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute("""
+                    INSERT INTO task_leases (task_id, owner, expires_at) VALUES (?, ?, ?)
+                    ON CONFLICT(task_id) DO UPDATE SET owner = excluded.owner, expires_at = excluded.expires_at
+                    WHERE task_leases.expires_at < ? OR task_leases.owner = excluded.owner
+                """, (task_id, owner, now + ttl, now))
+                await db.commit()
+                return cursor.rowcount > 0
+        except Exception as e:
+            logger.error(f"获取任务租约失败: {e}")
+            return False
+    
+    async def renew_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """续期任务租约，数据库出错（如 database is locked）时抛出异常"""
+        async with aiosqlite.connect(self.db_path) as db:
+            cursor = await db.execute(
+                "UPDATE task_leases SET expires_at = ? WHERE task_id = ? AND owner = ?",
+                (time.time() + ttl, task_id, owner)
+            )
+            await db.commit()
+            return cursor.rowcount > 0
+    
+    async def release_lease(self, task_id: str, owner: str):
+        """释放任务租约"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.execute(
+                    "DELETE FROM task_leases WHERE task_id = ? AND owner = ?",
+                    (task_id, owner)
+                )
+                await db.commit()
+        except Exception as e:
+            logger.error(f"释放任务租约失败: {e}")
+
+
+class KeyValueStateBackend(StateBackend):
+    """基于网络键值存储（Redis 协议）的共享存储后端
+
+    多个 AstrBot 实例连接同一个键值服务即可共享已分析仓库、答案缓存和任务。
+    client 只需提供 redis.asyncio 客户端的以下子集：
+    get / set(ex, nx, xx) / delete / zadd / zrem / zremrangebyscore / zcard / zrevrange / zrangebyscore。
+    """
+    
+    def __init__(self, client, prefix: str = "repoinsight"):
+        self.client = client
+        self.prefix = prefix
+    
+    # 已分析仓库和答案缓存的索引（有序集合），供快照导出时遍历
+    ANALYSIS_INDEX = "analysis_index"
+    ANSWER_INDEX = "answer_index"
+    
+    def _key(self, *parts: str) -> str:
+        return ":".join((self.prefix,) + parts)
+    
+    async def _get_json(self, key: str) -> Optional[Dict[str, Any]]:
+        raw = await self.client.get(key)
+        return json.loads(raw) if raw else None
+    
+    async def get_user_state(self, user_id: str) -> Optional[Dict[str, Any]]:
+        """获取用户状态"""
+        try:
+            return await self._get_json(self._key("user_state", user_id))
+        except Exception as e:
+            logger.error(f"获取用户状态失败: {e}")
+            return None
+    
+    async def set_user_state(self, user_id: str, current_repo_url: Optional[str], analysis_session_id: Optional[str]):
+        """设置用户状态"""
+        try:
+            await self.client.set(self._key("user_state", user_id), json.dumps({
+                'current_repo_url': current_repo_url,
+                'analysis_session_id': analysis_session_id
+            }))
+        except Exception as e:
+            logger.error(f"设置用户状态失败: {e}")
+    
+    async def clear_user_state(self, user_id: str):
+        """清除用户状态"""
+        try:
+            await self.client.delete(self._key("user_state", user_id))
+        except Exception as e:
+            logger.error(f"清除用户状态失败: {e}")
+    
+    async def add_task(self, session_id: str, repo_url: str, user_origin: str):
+        """添加分析任务，并写入用户索引、未完成索引和全局时间索引"""
+        try:
+            now = datetime.now()
+            task = {
+                'session_id': session_id,
+                'repo_url': repo_url,
+                'user_origin': user_origin,
+                'created_at': now.isoformat(),
+                'status': TASK_STATUS_PENDING,
+                'started_at': None,
+                'finished_at': None,
+                'duration_seconds': None,
+                'error_message': None
+            }
+            score = now.timestamp()
+            await self.client.set(self._key("task", session_id), json.dumps(task))
+            await self.client.zadd(self._key("tasks", "user", user_origin), {session_id: score})
+            await self.client.zadd(self._key("tasks", "unfinished"), {session_id: score})
+            await self.client.zadd(self._key("tasks", "all"), {session_id: score})
+        except Exception as e:
+            logger.error(f"添加任务失败: {e}")
+    
+    async def update_task_status(self, session_id: str, status: str, error_message: Optional[str] = None):
+        """更新任务状态，并记录开始/结束时间和耗时"""
+        try:
+            key = self._key("task", session_id)
+            task = await self._get_json(key)
+            if not task:
+                return
+            now = datetime.now()
+            task['status'] = status
+            if status == TASK_STATUS_PROCESSING:
+                task['started_at'] = task.get('started_at') or now.isoformat()
+            elif status in TASK_FINISHED_STATUSES:
+                started = datetime.fromisoformat(task.get('started_at') or task['created_at'])
+                task['finished_at'] = now.isoformat()
+                task['duration_seconds'] = (now - started).total_seconds()
+                task['error_message'] = error_message
+            await self.client.set(key, json.dumps(task))
+            if status in TASK_FINISHED_STATUSES:
+                await self.client.zrem(self._key("tasks", "unfinished"), session_id)
+                # 已结束任务按结束时间参与保留期计算
+                await self.client.zadd(self._key("tasks", "all"), {session_id: now.timestamp()})
+        except Exception as e:
+            logger.error(f"更新任务状态失败: {e}")
+    
+    async def remove_task(self, session_id: str):
+        """移除分析任务"""
+        try:
+            task = await self._get_json(self._key("task", session_id))
+            await self.client.delete(self._key("task", session_id))
+            await self.client.zrem(self._key("tasks", "unfinished"), session_id)
+            await self.client.zrem(self._key("tasks", "all"), session_id)
+            if task:
+                await self.client.zrem(self._key("tasks", "user", task['user_origin']), session_id)
+        except Exception as e:
+            logger.error(f"移除任务失败: {e}")
+    
+    async def _load_tasks(self, session_ids) -> list:
+        tasks = []
+        for session_id in session_ids:
+            task = await self._get_json(self._key("task", session_id))
+            if task:
+                tasks.append(task)
+        return tasks
+    
+    async def get_all_pending_tasks(self) -> list:
+        """获取所有未完成（排队中或处理中）的任务"""
+        try:
+            session_ids = await self.client.zrangebyscore(self._key("tasks", "unfinished"), "-inf", "+inf")
+            return await self._load_tasks(session_ids)
+        except Exception as e:
+            logger.error(f"获取待处理任务失败: {e}")
             return []
+    
+    async def get_user_tasks(self, user_origin: str, limit: int, offset: int) -> list:
+        """分页获取用户的任务，按创建时间倒序"""
+        try:
+            session_ids = await self.client.zrevrange(
+                self._key("tasks", "user", user_origin), offset, offset + limit - 1
+            )
+            return await self._load_tasks(session_ids)
         except Exception as e:
             logger.error(f"获取用户任务失败: {e}")
             return []
     
+    async def count_user_tasks(self, user_origin: str) -> int:
+        """统计用户的任务总数"""
+        try:
+            return await self.client.zcard(self._key("tasks", "user", user_origin))
+        except Exception as e:
+            logger.error(f"统计用户任务失败: {e}")
+            return 0
+    
+    async def purge_old_tasks(self, retention_days: int, archive: bool = True, vacuum_pages: int = 0,
+                              archive_retention_days: int = 90, answer_cache_ttl: float = 86400) -> int:
+        """清理超过保留期的任务，可选归档；归档、答案缓存和租约依赖键过期自动清理
+
+        答案缓存的键过期后，其在答案索引中的成员也在这里按缓存有效期一并删除。
+        """
+        try:
+            now = time.time()
+            await self.client.zremrangebyscore(self._key(self.ANSWER_INDEX), "-inf", now - answer_cache_ttl)
+            cutoff = now - retention_days * 86400
+            session_ids = await self.client.zrangebyscore(self._key("tasks", "all"), "-inf", cutoff)
+            for session_id in session_ids:
+                if archive:
+                    task = await self._get_json(self._key("task", session_id))
+                    if task:
+                        task['archived_at'] = datetime.now().isoformat()
+                        await self.client.set(
+                            self._key("task_archive", session_id), json.dumps(task),
+                            ex=archive_retention_days * 86400 if archive_retention_days else None
+                        )
+                await self.remove_task(session_id)
+            return len(session_ids)
+        except Exception as e:
+            logger.error(f"清理过期任务失败: {e}")
+            return 0
+    
+    async def register_analysis(self, repo_url: str, analysis_session_id: str):
+        """登记已分析完成的仓库"""
+        try:
+            analyzed_at = time.time()
+            await self.client.set(self._key("analysis", repo_url), json.dumps({
+                'analysis_session_id': analysis_session_id,
+                'analyzed_at': analyzed_at
+            }))
+            await self.client.zadd(self._key(self.ANALYSIS_INDEX), {repo_url: analyzed_at})
+        except Exception as e:
+            logger.error(f"登记已分析仓库失败: {e}")
+    
+    async def get_analysis(self, repo_url: str, max_age: float) -> Optional[str]:
+        """查找未过期的仓库分析会话ID"""
+        try:
+            record = await self._get_json(self._key("analysis", repo_url))
+            if record and record['analyzed_at'] >= time.time() - max_age:
+                return record['analysis_session_id']
+        except Exception as e:
+            logger.error(f"查询已分析仓库失败: {e}")
+        return None
+    
+    async def get_cached_answer(self, analysis_session_id: str, question: str, max_age: float) -> Optional[str]:
+        """查找未过期的缓存答案"""
+        try:
+            record = await self._get_json(self._key("answer", analysis_session_id, question_key(question)))
+            if record and record['created_at'] >= time.time() - max_age:
+                return record['answer']
+        except Exception as e:
+            logger.error(f"查询答案缓存失败: {e}")
+        return None
+    
+    async def cache_answer(self, analysis_session_id: str, question: str, answer: str, ttl: float):
+        """写入答案缓存，键在 ttl 后自动过期"""
+        try:
+            created_at = time.time()
+            key = self._key("answer", analysis_session_id, question_key(question))
+            await self.client.set(
+                key,
+                json.dumps({'question': question, 'answer': answer, 'created_at': created_at}),
+                ex=max(1, int(ttl))
+            )
+            await self.client.zadd(self._key(self.ANSWER_INDEX), {key: created_at})
+        except Exception as e:
+            logger.error(f"写入答案缓存失败: {e}")
+    
+    async def _iter_index(self, index: str, batch_size: int):
+        """按批遍历索引中的成员及其记录，顺带清理已过期的成员"""
+        index_key = self._key(index)
+        stale = []
+        start = 0
+        while True:
+            members = await self.client.zrevrange(index_key, start, start + batch_size - 1)
+            if not members:
+                break
+            start += len(members)
+            batch = []
+            for member in members:
+                key = self._key("analysis", member) if index == self.ANALYSIS_INDEX else member
+                record = await self._get_json(key)
+                if record is None:
+                    stale.append(member)
+                else:
+                    batch.append((member, record))
+            if batch:
+                yield batch
+        if stale:
+            await self.client.zrem(index_key, *stale)
+    
+    async def iter_analyses(self, batch_size: int):
+        """按批读取已分析仓库登记"""
+        async for batch in self._iter_index(self.ANALYSIS_INDEX, batch_size):
+            yield [{'repo_url': repo_url, **record} for repo_url, record in batch]
+    
+    async def iter_cached_answers(self, batch_size: int):
+        """按批读取答案缓存，答案键的格式为 <prefix>:answer:<分析会话ID>:<问题键>"""
+        async for batch in self._iter_index(self.ANSWER_INDEX, batch_size):
+            yield [
+                {'analysis_session_id': key.split(":")[-2], **record}
+                for key, record in batch
+            ]
+    
+    async def import_analyses(self, records: list) -> int:
+        """导入已分析仓库登记，本地记录更新时保留本地记录"""
+        imported = 0
+        for r in records:
+            key = self._key("analysis", r['repo_url'])
+            existing = await self._get_json(key)
+            if existing and existing['analyzed_at'] >= r['analyzed_at']:
+                continue
+            await self.client.set(key, json.dumps({
+                'analysis_session_id': r['analysis_session_id'],
+                'analyzed_at': r['analyzed_at']
+            }))
+            await self.client.zadd(self._key(self.ANALYSIS_INDEX), {r['repo_url']: r['analyzed_at']})
+            imported += 1
+        return imported
+    
+    async def import_cached_answers(self, records: list, ttl: float) -> int:
+        """导入答案缓存，键的过期时间按原始写入时间计算"""
+        imported = 0
+        now = time.time()
+        for r in records:
+            remaining = int(r['created_at'] + ttl - now)
+            if remaining <= 0:
+                continue
+            key = self._key("answer", r['analysis_session_id'], question_key(r['question']))
+            existing = await self._get_json(key)
+            if existing and existing['created_at'] >= r['created_at']:
+                continue
+            await self.client.set(
+                key,
+                json.dumps({'question': r['question'], 'answer': r['answer'], 'created_at': r['created_at']}),
+                ex=remaining
+            )
+            await self.client.zadd(self._key(self.ANSWER_INDEX), {key: r['created_at']})
+            imported += 1
+        return imported
+    
+    async def acquire_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """通过 SET NX 原子地获取任务租约"""
+        try:
+            key = self._key("lease", task_id)
+            if await self.client.set(key, owner, ex=max(1, int(ttl)), nx=True):
+                return True
+            # 已持有的租约视为获取成功并顺带续期
+            return await self.renew_lease(task_id, owner, ttl)
+        except Exception as e:
+            logger.error(f"获取任务租约失败: {e}")
+            return False
+    
+    async def renew_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """续期任务租约
+
+        先比对持有者再续期，两步之间租约过期会产生竞争，
+        调用方应在 ttl 的三分之一处续期以留出余量。键值服务出错时抛出异常。
+        """
+        key = self._key("lease", task_id)
+        if await self.client.get(key) != owner:
+            return False
+        return bool(await self.client.set(key, owner, ex=max(1, int(ttl)), xx=True))
+    
+    async def release_lease(self, task_id: str, owner: str):
+        """释放任务租约"""
+        try:
+            key = self._key("lease", task_id)
+            if await self.client.get(key) == owner:
+                await self.client.delete(key)
+        except Exception as e:
+            logger.error(f"释放任务租约失败: {e}")
+    
+    async def close(self):
+        """关闭键值服务连接"""
+        try:
+            close = getattr(self.client, "aclose", None) or getattr(self.client, "close", None)
+            if close:
+                await close()
+        except Exception as e:
+            logger.error(f"关闭键值存储连接失败: {e}")
+
+
+class InMemoryKeyValueClient:
+    """进程内键值存储，实现 KeyValueStateBackend 所需的 Redis 命令子集
+
+    用于单实例部署和在没有 Redis 的环境下测试共享后端，多个
+    KeyValueStateBackend 共用同一个实例即可模拟多个 AstrBot 节点。
+    """
+    
+    def __init__(self):
+        self._data: Dict[str, Any] = {}
+        self._expires: Dict[str, float] = {}
+    
+    def _alive(self, key: str) -> bool:
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at <= time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+    
+    async def get(self, key: str):
+        return self._data[key] if self._alive(key) else None
+    
+    async def set(self, key: str, value, ex: Optional[int] = None, nx: bool = False, xx: bool = False):
+        exists = self._alive(key)
+        if (nx and exists) or (xx and not exists):
+            return None
+        self._data[key] = value
+        if ex is not None:
+            self._expires[key] = time.time() + ex
+        else:
+            self._expires.pop(key, None)
+        return True
+    
+    async def delete(self, *keys: str) -> int:
+        removed = 0
+        for key in keys:
+            if self._alive(key):
+                removed += 1
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return removed
+    
+    def _zset(self, key: str) -> Dict[str, float]:
+        if not self._alive(key):
+            self._data[key] = {}
+        return self._data[key]
+    
+    async def zadd(self, key: str, mapping: Dict[str, float]) -> int:
+        zset = self._zset(key)
+        added = sum(1 for member in mapping if member not in zset)
+        zset.update(mapping)
+        return added
+    
+    async def zrem(self, key: str, *members: str) -> int:
+        zset = self._zset(key)
+        return sum(1 for member in members if zset.pop(member, None) is not None)
+    
+    async def zremrangebyscore(self, key: str, min_score, max_score) -> int:
+        low, high = float(min_score), float(max_score)
+        zset = self._zset(key)
+        stale = [member for member, score in zset.items() if low <= score <= high]
+        for member in stale:
+            del zset[member]
+        return len(stale)
+    
+    async def zcard(self, key: str) -> int:
+        return len(self._zset(key))
+    
+    async def zrevrange(self, key: str, start: int, end: int) -> list:
+        members = sorted(self._zset(key).items(), key=lambda item: item[1], reverse=True)
+        end = len(members) if end == -1 else end + 1
+        return [member for member, _ in members[start:end]]
+    
+    async def zrangebyscore(self, key: str, min_score, max_score) -> list:
+        low, high = float(min_score), float(max_score)
+        members = sorted(self._zset(key).items(), key=lambda item: item[1])
+        return [member for member, score in members if low <= score <= high]
+
+
+class StateManager:
+    """状态持久化管理器
+
+    持久化部分委托给 StateBackend。用户状态每次都从后端读取，不在进程内缓存，
+    多实例共享后端时其他实例上的仓库切换能立即生效。
+    """
+    
+    def __init__(self, backend: Optional[StateBackend] = None):
+        self.backend = backend or SQLiteStateBackend()
+        self._init_db_task = asyncio.create_task(self.backend.init())
+    
+    async def get_user_state(self, user_id: str) -> Dict[str, Any]:
+        """获取用户状态"""
+        await asyncio.shield(self._init_db_task)
+        stored = await self.backend.get_user_state(user_id)
+        return {
+            'current_repo_url': stored.get('current_repo_url') if stored else None,
+            'analysis_session_id': stored.get('analysis_session_id') if stored else None
+        }
+    
+    async def set_user_state(self, user_id: str, state: Dict[str, Any]):
+        """设置用户状态"""
+        await asyncio.shield(self._init_db_task)
+        await self.backend.set_user_state(
+            user_id, state.get('current_repo_url'), state.get('analysis_session_id')
+        )
+    
+    async def clear_user_state(self, user_id: str):
+        """清除用户状态"""
+        await asyncio.shield(self._init_db_task)
+        await self.backend.clear_user_state(user_id)
+    
+    async def add_task(self, session_id: str, repo_url: str, user_origin: str):
+        """添加分析任务"""
+        await asyncio.shield(self._init_db_task)  # 等待数据库初始化完成，shield 避免调用方被取消时连带取消初始化
+        await self.backend.add_task(session_id, repo_url, user_origin)
+    
+    async def update_task_status(self, session_id: str, status: str, error_message: Optional[str] = None):
+        """更新任务状态"""
+        await asyncio.shield(self._init_db_task)
+        await self.backend.update_task_status(session_id, status, error_message)
+    
+    async def remove_task(self, session_id: str):
+        """移除分析任务"""
+        await asyncio.shield(self._init_db_task)
+        await self.backend.remove_task(session_id)
+    
+    async def get_all_pending_tasks(self):
+        """获取所有未完成的任务"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.get_all_pending_tasks()
+    
+    async def get_user_tasks(self, user_origin: str, limit: int = 5, offset: int = 0):
+        """分页获取用户的任务"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.get_user_tasks(user_origin, limit, offset)
+    
+    async def count_user_tasks(self, user_origin: str) -> int:
+        """统计用户的任务总数"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.count_user_tasks(user_origin)
+    
+    async def purge_old_tasks(self, retention_days: int, archive: bool = True, vacuum_pages: int = 0,
+                              archive_retention_days: int = 90, answer_cache_ttl: float = 86400) -> int:
+        """清理超过保留期的任务"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.purge_old_tasks(
+            retention_days, archive, vacuum_pages, archive_retention_days, answer_cache_ttl
+        )
+    
+    async def register_analysis(self, repo_url: str, analysis_session_id: str):
+        """登记已分析完成的仓库"""
+        await asyncio.shield(self._init_db_task)
+        await self.backend.register_analysis(repo_url, analysis_session_id)
+    
+    async def get_analysis(self, repo_url: str, max_age: float) -> Optional[str]:
+        """查找未过期的仓库分析会话ID"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.get_analysis(repo_url, max_age)
+    
+    async def get_cached_answer(self, analysis_session_id: str, question: str, max_age: float) -> Optional[str]:
+        """查找缓存答案"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.get_cached_answer(analysis_session_id, question, max_age)
+    
+    async def cache_answer(self, analysis_session_id: str, question: str, answer: str, ttl: float):
+        """写入答案缓存"""
+        await asyncio.shield(self._init_db_task)
+        await self.backend.cache_answer(analysis_session_id, question, answer, ttl)
+    
+    async def iter_analyses(self, batch_size: int):
+        """按批遍历已分析仓库登记"""
+        await asyncio.shield(self._init_db_task)
+        async for batch in self.backend.iter_analyses(batch_size):
+            yield batch
+    
+    async def iter_cached_answers(self, batch_size: int):
+        """按批遍历答案缓存"""
+        await asyncio.shield(self._init_db_task)
+        async for batch in self.backend.iter_cached_answers(batch_size):
+            yield batch
+    
+    async def import_analyses(self, records: list) -> int:
+        """导入已分析仓库登记"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.import_analyses(records)
+    
+    async def import_cached_answers(self, records: list, ttl: float) -> int:
+        """导入答案缓存"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.import_cached_answers(records, ttl)
+    
+    async def acquire_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """获取任务租约"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.acquire_lease(task_id, owner, ttl)
+    
+    async def renew_lease(self, task_id: str, owner: str, ttl: float) -> bool:
+        """续期任务租约"""
+        await asyncio.shield(self._init_db_task)
+        return await self.backend.renew_lease(task_id, owner, ttl)
+    
+    async def release_lease(self, task_id: str, owner: str):
+        """释放任务租约"""
+        await asyncio.shield(self._init_db_task)
+        await self.backend.release_lease(task_id, owner)
+    
     async def close(self):
         """关闭状态管理器"""
         try:
             if hasattr(self, '_init_db_task'):
-                await self._init_db_task
+                await asyncio.shield(self._init_db_task)
+            await self.backend.close()
         except Exception as e:
             logger.error(f"关闭状态管理器失败: {e}")
+
+
+# 缓存快照格式：gzip 压缩的 JSON Lines
+SNAPSHOT_FORMAT = "repoinsight-snapshot"
+SNAPSHOT_VERSION = 1
+SNAPSHOT_BATCH_SIZE = 500
+
+
+class SnapshotError(Exception):
+    """快照文件不是 RepoInsight 快照或版本不受支持"""
+
+
+class CacheSnapshot:
+    """已分析仓库登记和答案缓存的快照
+
+    文件为 gzip 压缩的 JSON Lines：第一行是 header（格式名、版本、导出时间和实例），
+    随后每行一条 analysis 或 answer 记录，最后一行是记录数汇总的 end 记录，
+    缺少 end 记录说明快照被截断。导出和导入都按批读写，内存占用与快照大小无关。
+    """
+    
+    def __init__(self, state_manager: StateManager, batch_size: int = SNAPSHOT_BATCH_SIZE):
+        self.state_manager = state_manager
+        self.batch_size = batch_size
+    
+    async def export(self, path: str, instance_id: str) -> Dict[str, int]:
+        """导出快照，先写临时文件再替换，导出中途失败不会破坏已有快照"""
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        counts = {"analyses": 0, "answers": 0}
+        fh = await asyncio.to_thread(gzip.open, tmp_path, "wt", encoding="utf-8")
+        try:
+            await self._write(fh, [{
+                "type": "header",
+                "format": SNAPSHOT_FORMAT,
+                "version": SNAPSHOT_VERSION,
+                "created_at": time.time(),
+                "instance": instance_id,
+            }])
+            async for batch in self.state_manager.iter_analyses(self.batch_size):
+                await self._write(fh, [{"type": "analysis", **record} for record in batch])
+                counts["analyses"] += len(batch)
+            async for batch in self.state_manager.iter_cached_answers(self.batch_size):
+                await self._write(fh, [{"type": "answer", **record} for record in batch])
+                counts["answers"] += len(batch)
+            await self._write(fh, [{"type": "end", **counts}])
+        except BaseException:
+            await asyncio.to_thread(fh.close)
+            os.remove(tmp_path)
+            raise
+        await asyncio.to_thread(fh.close)
+        os.replace(tmp_path, path)
+        return counts
+    
+    async def load(self, path: str, analysis_max_age: float, answer_ttl: float) -> Dict[str, Any]:
+        """导入快照，跳过已过期的记录，本地已有更新的记录时保留本地记录"""
+        result = {"analyses": 0, "answers": 0, "expired": 0, "invalid": 0, "complete": False}
+        fh = await asyncio.to_thread(gzip.open, path, "rt", encoding="utf-8")
+        try:
+            try:
+                header = json.loads((await asyncio.to_thread(fh.readline)) or "{}")
+            except (OSError, EOFError, ValueError) as e:
+                raise SnapshotError(f"无法读取快照文件: {e}")
+            if header.get("type") != "header" or header.get("format") != SNAPSHOT_FORMAT:
+                raise SnapshotError("不是 RepoInsight 快照文件")
+            if header.get("version", 0) > SNAPSHOT_VERSION:
+                raise SnapshotError(f"快照版本 {header.get('version')} 高于当前支持的版本 {SNAPSHOT_VERSION}")
+            result["created_at"] = header.get("created_at")
+            
+            truncated = False
+            while not truncated:
+                lines, truncated = await asyncio.to_thread(self._read_lines, fh, self.batch_size)
+                if not lines:
+                    break
+                now = time.time()
+                analyses, answers = [], []
+                for line in lines:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # 截断处的半行记录
+                        result["invalid"] += 1
+                        continue
+                    kind = record.pop("type", None)
+                    if kind == "analysis":
+                        if record["analyzed_at"] >= now - analysis_max_age:
+                            analyses.append(record)
+                        else:
+                            result["expired"] += 1
+                    elif kind == "answer":
+                        if record["created_at"] >= now - answer_ttl:
+                            answers.append(record)
+                        else:
+                            result["expired"] += 1
+                    elif kind == "end":
+                        result["complete"] = True
+                if analyses:
+                    result["analyses"] += await self.state_manager.import_analyses(analyses)
+                if answers:
+                    result["answers"] += await self.state_manager.import_cached_answers(answers, answer_ttl)
+        finally:
+            await asyncio.to_thread(fh.close)
+        return result
+    
+    @staticmethod
+    async def _write(fh, records: list):
+        data = "".join(json.dumps(record, ensure_ascii=False) + "\n" for record in records)
+        await asyncio.to_thread(fh.write, data)
+    
+    @staticmethod
+    def _read_lines(fh, count: int) -> tuple:
+        """读取至多 count 个非空行，返回 (行列表, 文件是否被截断)
+
+        截断的 gzip 文件在读到末尾时报错，此时返回已读到的行，让这一批照常导入。
+        """
+        lines = []
+        for _ in range(count):
+            try:
+                line = fh.readline()
+            except (OSError, EOFError) as e:
+                logger.warning(f"快照文件不完整: {e}")
+                return lines, True
+            if not line:
+                break
+            if line.strip():
+                lines.append(line)
+        return lines, False
+
+
+# 当前请求的追踪上下文，随 asyncio 任务自动传递
+_current_trace: ContextVar[Optional["Trace"]] = ContextVar("repoinsight_trace", default=None)
+
+
+class Trace:
+    """单次分析或问答请求的事件时间线"""
+    
+    MAX_EVENTS = 200
+    
+    def __init__(self, kind: str, attrs: Dict[str, Any]):
+        self.trace_id = uuid.uuid4().hex[:16]
+        self.kind = kind
+        self.attrs = attrs
+        self.started_at = datetime.now()
+        self.duration: Optional[float] = None
+        self.outcome = "unknown"
+        self.events = []
+        self.dropped_events = 0
+        self._start = time.monotonic()
+        self._token = None
+    
+    def event(self, name: str, **detail):
+        """记录一个事件，超过上限后只计数不再保存"""
+        if len(self.events) >= self.MAX_EVENTS:
+            self.dropped_events += 1
+            return
+        self.events.append((time.monotonic() - self._start, name, detail))
+    
+    def elapsed(self) -> float:
+        return self.duration if self.duration is not None else time.monotonic() - self._start
+    
+    def format(self) -> str:
+        """格式化为紧凑的多行时间线"""
+        attrs = " ".join(f"{key}={value}" for key, value in self.attrs.items())
+        lines = [
+            f"[{self.trace_id}] {self.kind} {self.outcome} {self.elapsed():.1f}s "
+            f"@{self.started_at.strftime('%m-%d %H:%M:%S')} {attrs}"
+        ]
+        for offset, name, detail in self.events:
+            detail_text = " ".join(f"{key}={value}" for key, value in detail.items())
+            lines.append(f"  +{offset:7.2f}s {name} {detail_text}".rstrip())
+        if self.dropped_events:
+            lines.append(f"  ... 另有 {self.dropped_events} 个事件未记录")
+        return "\n".join(lines)
+
+
+class FlightRecorder:
+    """请求飞行记录器
+
+    为每次分析和问答生成追踪ID，记录关键事件，已结束的追踪保存在
+    有界环形缓冲区中，耗时超过所属类型阈值的请求自动输出完整时间线到日志。
+    """
+    
+    TRACE_HEADER = "X-Trace-Id"
+    
+    def __init__(self, capacity: int = 200, slow_threshold: float = 60.0,
+                 kind_thresholds: Optional[Dict[str, float]] = None):
+        self.slow_threshold = slow_threshold
+        # 按追踪类型覆盖的慢请求阈值
+        self.kind_thresholds = kind_thresholds or {}
+        self._traces = deque(maxlen=capacity)
+    
+    def threshold(self, kind: str) -> float:
+        return self.kind_thresholds.get(kind, self.slow_threshold)
+    
+    def start(self, kind: str, **attrs) -> Trace:
+        """开始追踪，并设为当前上下文的追踪"""
+        trace = Trace(kind, attrs)
+        trace._token = _current_trace.set(trace)
+        trace.event("start")
+        return trace
+    
+    def finish(self, trace: Trace, outcome: Optional[str] = None):
+        """结束追踪并放入环形缓冲区，重复调用无效"""
+        if trace.duration is not None:
+            return
+        if outcome:
+            trace.outcome = outcome
+        trace.event("finish")
+        trace.duration = time.monotonic() - trace._start
+        try:
+            _current_trace.reset(trace._token)
+        except ValueError:
+            # 在其他上下文中结束（如后台任务），只需保证不再被引用
+            pass
+        self._traces.append(trace)
+        threshold = self.threshold(trace.kind)
+        if trace.duration >= threshold:
+            logger.warning(f"慢请求 ({trace.duration:.1f}s >= {threshold}s):\n{trace.format()}")
+    
+    def slowest(self, count: int, kind: Optional[str] = None) -> list:
+        """返回最近已结束追踪中最慢的若干条
+
+        指定 kind 时只看该类型并按耗时排序；否则按耗时与所属类型阈值的比值排序，
+        避免本来就要数分钟的分析淹没慢问答。
+        """
+        if kind:
+            traces = [trace for trace in self._traces if trace.kind == kind]
+            return sorted(traces, key=lambda trace: trace.duration, reverse=True)[:count]
+        return sorted(
+            self._traces, key=lambda trace: trace.duration / max(self.threshold(trace.kind), 0.001), reverse=True
+        )[:count]
+    
+    @staticmethod
+    def current() -> Optional[Trace]:
+        return _current_trace.get()
+    
+    @staticmethod
+    def record(name: str, **detail):
+        """向当前追踪记录事件，没有追踪时忽略"""
+        trace = _current_trace.get()
+        if trace:
+            trace.event(name, **detail)
+    
+    @classmethod
+    def headers(cls) -> Dict[str, str]:
+        """传递给 GithubBot 的追踪请求头"""
+        trace = _current_trace.get()
+        return {cls.TRACE_HEADER: trace.trace_id} if trace else {}
+
+
+class PluginMetrics:
+    """进程内运行指标，计数器累加，观测值保留最新值"""
+    
+    def __init__(self):
+        self.counters: Dict[str, int] = defaultdict(int)
+        self.gauges: Dict[str, float] = {}
+    
+    def incr(self, name: str, value: int = 1):
+        self.counters[name] += value
+    
+    def set_gauge(self, name: str, value: float):
+        self.gauges[name] = value
+    
+    def format(self) -> str:
+        lines = [f"• {name}: {value}" for name, value in sorted(self.counters.items())]
+        lines += [f"• {name}: {value:.3f}" for name, value in sorted(self.gauges.items())]
+        return "\n".join(lines)
+
+
+GENERATION_MODES = ("service", "plugin")
+
+
+class GenerationRouter:
+    """根据滚动延迟和错误率在服务端生成和插件端生成之间选择
+
+    每种模式保留最近 window 次请求的耗时和成功与否；样本不足的模式优先试探，
+    之后在错误率不超过 max_error_rate 的模式中选择平均耗时最低的，
+    并每隔 explore_every 次决策试探一次另一种模式，保持统计数据新鲜。
+    """
+    
+    def __init__(self, metrics: PluginMetrics, forced_mode: str = "auto", window: int = 20,
+                 min_samples: int = 3, max_error_rate: float = 0.5, explore_every: int = 10):
+        self.metrics = metrics
+        self.forced_mode = forced_mode
+        self.min_samples = min_samples
+        self.max_error_rate = max_error_rate
+        self.explore_every = explore_every
+        self._samples = {mode: deque(maxlen=window) for mode in GENERATION_MODES}
+        self._decisions = 0
+    
+    def error_rate(self, mode: str) -> float:
+        samples = self._samples[mode]
+        return sum(1 for _, ok in samples if not ok) / len(samples) if samples else 0.0
+    
+    def mean_latency(self, mode: str) -> Optional[float]:
+        latencies = [latency for latency, ok in self._samples[mode] if ok]
+        return sum(latencies) / len(latencies) if latencies else None
+    
+    def choose(self, plugin_available: bool = True) -> str:
+        """为一个问题选择生成模式"""
+        if not plugin_available:
+            # 未配置 AstrBot 的 LLM 提供商时插件端无法生成，强制 plugin 模式也降级为 service
+            mode, reason = "service", "no_provider"
+        elif self.forced_mode in GENERATION_MODES:
+            mode, reason = self.forced_mode, "forced"
+        else:
+            mode, reason = self._choose_adaptive()
+        self.metrics.incr(f"generation.route.{mode}")
+        self.metrics.incr(f"generation.reason.{reason}")
+        FlightRecorder.record("generation_route", mode=mode, reason=reason)
+        return mode
+    
+    def _choose_adaptive(self):
+        self._decisions += 1
+        for mode in GENERATION_MODES:
+            if len(self._samples[mode]) < self.min_samples:
+                return mode, "warmup"
+        
+        healthy = [mode for mode in GENERATION_MODES if self.error_rate(mode) <= self.max_error_rate]
+        if not healthy:
+            return min(GENERATION_MODES, key=self.error_rate), "least_errors"
+        best = min(healthy, key=lambda mode: self.mean_latency(mode) or float("inf"))
+        
+        others = [mode for mode in healthy if mode != best]
+        if others and self._decisions % self.explore_every == 0:
+            return others[0], "explore"
+        return best, "fastest"
+    
+    def record(self, mode: str, latency: float, ok: bool):
+        """记录一次请求的结果并更新指标"""
+        self._samples[mode].append((latency, ok))
+        self.metrics.incr(f"generation.{mode}.{'ok' if ok else 'error'}")
+        self.metrics.set_gauge(f"generation.{mode}.error_rate", self.error_rate(mode))
+        mean_latency = self.mean_latency(mode)
+        if mean_latency is not None:
+            self.metrics.set_gauge(f"generation.{mode}.mean_latency_s", mean_latency)
+
+
+# 检索词提取：代码标识符/英文单词，以及不含英文时的中文三字片段
+_ASCII_TERM_PATTERN = re.compile(r"[A-Za-z_][A-Za-z0-9_]{2,}")
+_CJK_RUN_PATTERN = re.compile(r"[\u4e00-\u9fff]{3,}")
+_TERM_STOPWORDS = {
+    "the", "and", "how", "what", "this", "that", "does", "with", "for", "are",
+    "can", "which", "where", "when", "why", "from", "into", "about", "you", "use",
+}
+
+
+class ChunkIndex:
+    """已分析仓库的本地全文检索索引
+
+    缓存历次查询返回的 retrieved_context 片段（按 analysis_session_id 和 file_path），
+    后续问题的检索词在本地片段中的覆盖率足够时，可直接用本地片段生成答案。
+    每个会话的片段数和索引总大小都有上限，超出时淘汰会话内最旧的片段，
+    再按最近使用时间整会话淘汰。
+    """
+    
+    def __init__(self, db_path: str = os.path.join("data", "repoinsight_chunks.db"),
+                 max_bytes: int = 50 * 1024 * 1024, max_chunks_per_session: int = 500,
+                 min_coverage: float = 0.6, min_chunks: int = 3):
+        self.db_path = db_path
+        self.max_bytes = max_bytes
+        self.max_chunks_per_session = max_chunks_per_session
+        self.min_coverage = min_coverage
+        self.min_chunks = min_chunks
+        os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        # 写入和淘汰串行执行，避免并发统计大小时互相干扰
+        self._write_lock = asyncio.Lock()
+        self._init_task = asyncio.create_task(self._init_db())
+    
+    async def _init_db(self):
+        """初始化索引表，FTS5 trigram 分词不可用时回退到 unicode61"""
+        try:
+            async with aiosqlite.connect(self.db_path) as db:
+                await db.executescript("""
+                    CREATE TABLE IF NOT EXISTS chunks (
+                        id INTEGER PRIMARY KEY AUTOINCREMENT,
+                        analysis_session_id TEXT NOT NULL,
+                        file_path TEXT NOT NULL,
+                        content TEXT NOT NULL,
+                        content_hash TEXT NOT NULL,
+                        size INTEGER NOT NULL,
+                        UNIQUE (analysis_session_id, file_path, content_hash)
+                    );
+                    CREATE TABLE IF NOT EXISTS chunk_sessions (
+                        analysis_session_id TEXT PRIMARY KEY,
+                        last_used REAL NOT NULL
+                    );
+                """)
+                try:
+                    await db.execute(
+                        "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5("
+                        "content, file_path, content='chunks', content_rowid='id', tokenize='trigram')"
+                    )
+                except Exception:
+                    await db.execute(
+                        "CREATE VIRTUAL TABLE IF NOT EXISTS chunks_fts USING fts5("
+                        "content, file_path, content='chunks', content_rowid='id')"
+                    )
+                await db.executescript("""
+                    CREATE TRIGGER IF NOT EXISTS chunks_ai AFTER INSERT ON chunks BEGIN
+                        INSERT INTO chunks_fts (rowid, content, file_path) VALUES (new.id, new.content, new.file_path);
+                    END;
+                    CREATE TRIGGER IF NOT EXISTS chunks_ad AFTER DELETE ON chunks BEGIN
+                        INSERT INTO chunks_fts (chunks_fts, rowid, content, file_path) VALUES ('delete', old.id, old.content, old.file_path);
+                    END;
+                """)
+                await db.commit()
+        except Exception as e:
+            logger.error(f"初始化本地检索索引失败: {e}")
+    
+    @staticmethod
+    def extract_terms(question: str) -> list:
+        """提取检索词，问题含英文/标识符时只用英文词，否则用中文三字片段"""
+        terms = []
+        for word in _ASCII_TERM_PATTERN.findall(question):
+            word = word.lower()
+            if word not in _TERM_STOPWORDS and word not in terms:
+                terms.append(word)
+        if terms:
+            return terms[:16]
+        for run in _CJK_RUN_PATTERN.findall(question):
+            for i in range(len(run) - 2):
+                if run[i:i + 3] not in terms:
+                    terms.append(run[i:i + 3])
+        return terms[:16]
+    
+    async def add_chunks(self, analysis_session_id: str, context_list: list) -> int:
+        """写入检索到的上下文片段，返回新增片段数"""
+        rows = []
+        for ctx in context_list:
+            content = ctx.get('content') or ''
+            if not content:
+                continue
+            rows.append((
+                analysis_session_id,
+                ctx.get('file_path') or 'Unknown',
+                content,
+                hashlib.sha1(content.encode("utf-8")).hexdigest(),
+                len(content.encode("utf-8"))
+            ))
+        if not rows:
+            return 0
+        try:
+            await asyncio.shield(self._init_task)
+            async with self._write_lock:
+                async with aiosqlite.connect(self.db_path) as db:
+                    count_sql = "SELECT COUNT(*) FROM chunks WHERE analysis_session_id = ?"
+                    before = (await (await db.execute(count_sql, (analysis_session_id,))).fetchone())[0]
+                    await db.executemany(
+                        "INSERT OR IGNORE INTO chunks (analysis_session_id, file_path, content, content_hash, size) VALUES (?, ?, ?, ?, ?)",
+                        rows
+                    )
+                    inserted = (await (await db.execute(count_sql, (analysis_session_id,))).fetchone())[0] - before
+                    await db.execute(
+                        "INSERT OR REPLACE INTO chunk_sessions (analysis_session_id, last_used) VALUES (?, ?)",
+                        (analysis_session_id, time.time())
+                    )
+                    await self._enforce_limits(db, analysis_session_id)
+                    await db.commit()
+                    # 淘汰从最旧的片段开始，新写入的片段最多保留到会话剩余片段数
+                    remaining = (await (await db.execute(count_sql, (analysis_session_id,))).fetchone())[0]
+                    return min(inserted, remaining)
+        except Exception as e:
+            logger.error(f"写入本地检索索引失败: {e}")
+            return 0
+    
+    async def _enforce_limits(self, db, analysis_session_id: str):
+        """按会话片段数上限和索引总大小上限淘汰"""
+        await db.execute("""
+            DELETE FROM chunks WHERE id IN (
+                SELECT id FROM chunks WHERE analysis_session_id = ?
+                ORDER BY id DESC LIMIT -1 OFFSET ?
+            )
+        """, (analysis_session_id, self.max_chunks_per_session))
+        
+        while True:
+            cursor = await db.execute("SELECT COALESCE(SUM(size), 0) FROM chunks")
+            total_bytes = (await cursor.fetchone())[0]
+            if total_bytes <= self.max_bytes:
+                return
+            # 优先淘汰最久未使用的其他会话，只剩当前会话时淘汰其最旧的片段
+            cursor = await db.execute(
+                "SELECT analysis_session_id FROM chunk_sessions WHERE analysis_session_id != ? ORDER BY last_used LIMIT 1",
+                (analysis_session_id,)
+            )
+            row = await cursor.fetchone()
+            if row:
+                logger.info(f"本地检索索引超出上限，淘汰会话: {row[0]}")
+                await db.execute("DELETE FROM chunks WHERE analysis_session_id = ?", (row[0],))
+                await db.execute("DELETE FROM chunk_sessions WHERE analysis_session_id = ?", (row[0],))
+            else:
+                await db.execute(
+                    "DELETE FROM chunks WHERE id = (SELECT MIN(id) FROM chunks WHERE analysis_session_id = ?)",
+                    (analysis_session_id,)
+                )
+    
+    async def search(self, analysis_session_id: str, question: str, limit: int = 5) -> list:
+        """检索本地片段，检索词覆盖率或命中片段数不足时返回空列表"""
+        terms = self.extract_terms(question)
+        if not terms:
+            return []
+        match_query = " OR ".join(f'"{term}"' for term in terms)
+        try:
+            await asyncio.shield(self._init_task)
+            async with aiosqlite.connect(self.db_path) as db:
+                cursor = await db.execute("""
+                    SELECT c.file_path, c.content FROM chunks_fts
+                    JOIN chunks c ON c.id = chunks_fts.rowid
+                    WHERE chunks_fts MATCH ? AND c.analysis_session_id = ?
+                    ORDER BY bm25(chunks_fts) LIMIT ?
+                """, (match_query, analysis_session_id, limit))
+                rows = await cursor.fetchall()
+                if len(rows) < self.min_chunks:
+                    return []
+                
+                haystack = "\n".join(f"{file_path}\n{content}" for file_path, content in rows).lower()
+                coverage = sum(1 for term in terms if term in haystack) / len(terms)
+                if coverage < self.min_coverage:
+                    logger.info(f"本地检索覆盖率不足: {coverage:.2f} < {self.min_coverage}")
+                    return []
+                
+                await db.execute(
+                    "UPDATE chunk_sessions SET last_used = ? WHERE analysis_session_id = ?",
+                    (time.time(), analysis_session_id)
+                )
+                await db.commit()
+                return [{'file_path': file_path, 'content': content} for file_path, content in rows]
+        except Exception as e:
+            logger.error(f"本地检索失败: {e}")
+            return []
+    
+    async def evict_session(self, analysis_session_id: str):
+        """删除某个会话的全部片段"""
+        try:
+            await asyncio.shield(self._init_task)
+            async with self._write_lock:
+                async with aiosqlite.connect(self.db_path) as db:
+                    await db.execute("DELETE FROM chunks WHERE analysis_session_id = ?", (analysis_session_id,))
+                    await db.execute("DELETE FROM chunk_sessions WHERE analysis_session_id = ?", (analysis_session_id,))
+                    await db.commit()
+        except Exception as e:
+            logger.error(f"清理本地检索索引失败: {e}")
+
+
+class TaskLeaseLost(Exception):
+    """未能获取任务租约，或处理期间租约已被其他实例接管"""
+
+
+class JobCancelled(Exception):
+    """在途任务因用户退出、切换仓库或会话超时被取消"""
+    
+    def __init__(self, reason: str):
+        super().__init__(f"任务已取消: {reason}")
+        self.reason = reason
+
+
+class TrackedJob:
+    """一个正在进行的轮询任务及其在 GithubBot 上对应的作业"""
+    
+    def __init__(self, user_id: str, kind: str, task: asyncio.Task, backend_id: Optional[str],
+                 backend_kind: str = "analysis"):
+        self.user_id = user_id
+        self.kind = kind
+        self.task = task
+        self.backend_id = backend_id
+        # 后端作业类型（analysis/query），决定调用哪个取消接口
+        self.backend_kind = backend_kind
+        self.cancel_reason: Optional[str] = None
+    
+    async def wait(self):
+        """等待任务结果，被 JobTracker 取消时抛出 JobCancelled"""
+        try:
+            return await self.task
+        except asyncio.CancelledError:
+            if self.cancel_reason:
+                raise JobCancelled(self.cancel_reason)
+            raise
+
+
+class JobTracker:
+    """按用户跟踪在途任务，用户离开时取消轮询并通知后端取消作业"""
+    
+    def __init__(self, metrics: PluginMetrics, cancel_backend=None):
+        self.metrics = metrics
+        # cancel_backend(job) 协程负责调用后端取消接口
+        self.cancel_backend = cancel_backend
+        self._jobs: Dict[str, set] = defaultdict(set)
+    
+    def start(self, user_id: str, kind: str, coro, backend_id: Optional[str] = None,
+              backend_kind: str = "analysis") -> TrackedJob:
+        """以任务方式运行协程（或等待 asyncio.shield 等 Future）并登记，完成后自动注销"""
+        job = TrackedJob(user_id, kind, asyncio.ensure_future(coro), backend_id, backend_kind)
+        self._jobs[user_id].add(job)
+        job.task.add_done_callback(lambda _: self._discard(job))
+        return job
+    
+    def _discard(self, job: TrackedJob):
+        jobs = self._jobs.get(job.user_id)
+        if jobs is not None:
+            jobs.discard(job)
+            if not jobs:
+                self._jobs.pop(job.user_id, None)
+    
+    def active(self, user_id: str) -> list:
+        return list(self._jobs.get(user_id, ()))
+    
+    async def cancel_user(self, user_id: str, reason: str) -> int:
+        """取消用户的全部在途任务，返回取消数量"""
+        jobs = [job for job in self.active(user_id) if not job.task.done()]
+        for job in jobs:
+            job.cancel_reason = reason
+            job.task.cancel()
+            self.metrics.incr(f"jobs.cancelled.{reason}")
+            self.metrics.incr(f"jobs.cancelled.{job.kind}")
+            logger.info(f"已取消用户 {user_id} 的{job.kind}任务 {job.backend_id} ({reason})")
+        if self.cancel_backend:
+            await asyncio.gather(
+                *(self.cancel_backend(job) for job in jobs if job.backend_id),
+                return_exceptions=True
+            )
+        return len(jobs)
+
+
+class DeadlineExceeded(Exception):
+    """操作的总时间预算在某个阶段用尽"""
+    
+    def __init__(self, stage: str, budget: float):
+        super().__init__(f"在「{stage}」阶段用尽了 {budget:.0f} 秒的时间预算")
+        self.stage = stage
+        self.budget = budget
+
+
+class Deadline:
+    """单次用户操作的总时间预算
+
+    在收到用户消息时创建，并依次传给提交、轮询、获取结果和生成答案各阶段，
+    每次 HTTP 请求和 LLM 调用只能使用剩余的预算。
+    """
+    
+    # 计时器可能比预期略早触发，剩余时间低于该值即视为用尽
+    TOLERANCE = 0.1
+    
+    def __init__(self, budget: float):
+        self.budget = budget
+        self.expires_at = time.monotonic() + budget
+    
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+    
+    def extend_to(self, other: "Deadline"):
+        """把截止时间延长到 other 的截止时间（只延长不缩短），预算随之增加"""
+        if other.expires_at > self.expires_at:
+            self.budget += other.expires_at - self.expires_at
+            self.expires_at = other.expires_at
+    
+    def check(self, stage: str):
+        """预算已用尽时抛出 DeadlineExceeded"""
+        if self.remaining() <= self.TOLERANCE:
+            FlightRecorder.record("deadline_exceeded", stage=stage)
+            raise DeadlineExceeded(stage, self.budget)
+    
+    def http_timeout(self, stage: str, cap: Optional[float] = None) -> aiohttp.ClientTimeout:
+        """单次 HTTP 请求的超时：剩余预算，且不超过 cap"""
+        self.check(stage)
+        remaining = self.remaining()
+        return aiohttp.ClientTimeout(total=min(remaining, cap) if cap else remaining)
+    
+    async def sleep(self, seconds: float, stage: str):
+        """在预算内等待，等待后预算用尽则抛出 DeadlineExceeded"""
+        self.check(stage)
+        await asyncio.sleep(min(seconds, self.remaining()))
+        self.check(stage)
+    
+    async def run(self, awaitable, stage: str):
+        """在剩余预算内等待任意协程"""
+        self.check(stage)
+        try:
+            return await asyncio.wait_for(awaitable, self.remaining())
+        except asyncio.TimeoutError:
+            FlightRecorder.record("deadline_exceeded", stage=stage)
+            raise DeadlineExceeded(stage, self.budget)
+
+
+# 批量分析中单个仓库的状态及显示文字
+BATCH_STATUS_LABELS = {
+    "pending": "⏳ 等待中",
+    "running": "🔄 分析中",
+    "retrying": "🔁 等待重试",
+    "success": "✅ 已完成",
+    "reused": "♻️ 已复用",
+    "failed": "❌ 失败",
+    "cancelled": "🛑 已取消",
+}
+BATCH_FINISHED_STATUSES = ("success", "reused", "failed", "cancelled")
+
+# 批量分析进度消息的最小间隔（秒），避免仓库较多时刷屏
+BATCH_PROGRESS_INTERVAL = 60
+
+
+class BatchProgress:
+    """一次批量分析的进度，记录每个仓库的状态、尝试次数和失败原因"""
+    
+    def __init__(self, repo_urls: list):
+        self.repo_urls = list(repo_urls)
+        self.statuses: Dict[str, str] = {url: "pending" for url in self.repo_urls}
+        self.attempts: Dict[str, int] = defaultdict(int)
+        self.errors: Dict[str, str] = {}
+        self.started = time.monotonic()
+        self.last_report = self.started
+    
+    def set(self, repo_url: str, status: str, error: Optional[str] = None):
+        self.statuses[repo_url] = status
+        if error:
+            self.errors[repo_url] = error
+        elif status in ("success", "reused"):
+            self.errors.pop(repo_url, None)
+    
+    def finished(self) -> int:
+        return sum(1 for status in self.statuses.values() if status in BATCH_FINISHED_STATUSES)
+    
+    def format(self, detail: bool = False) -> str:
+        counts = defaultdict(int)
+        for status in self.statuses.values():
+            counts[status] += 1
+        elapsed = int(time.monotonic() - self.started)
+        lines = [
+            f"📦 批量分析进度: {self.finished()}/{len(self.repo_urls)}",
+            " · ".join(f"{label} {counts[status]}" for status, label in BATCH_STATUS_LABELS.items() if counts[status]),
+            f"⏱️ 已用时: {elapsed // 60}分{elapsed % 60}秒",
+        ]
+        if detail:
+            lines.append("")
+            for url in self.repo_urls:
+                line = f"{BATCH_STATUS_LABELS[self.statuses[url]]} {url}"
+                if self.attempts[url] > 1:
+                    line += f"（第 {self.attempts[url]} 次尝试）"
+                if url in self.errors and self.statuses[url] in ("failed", "retrying"):
+                    line += f"\n   原因: {self.errors[url]}"
+                lines.append(line)
+        return "\n".join(lines)
+
+
+class SharedQuery:
+    """同一仓库相同问题的在途查询，结果由所有等待的提问者共享"""
+    
+    def __init__(self, tracker_key: str, deadline: Deadline):
+        # 共享查询及其轮询任务在 JobTracker 中登记的键
+        self.tracker_key = tracker_key
+        # 查询自己的截止时间，每个加入的提问者都会把它延长到自己的截止时间
+        self.deadline = deadline
+        self.job: Optional[TrackedJob] = None
+        self.waiters = 0
@@ -0,0 +1,61 @@
+"""测试环境：未安装 AstrBot 时注入插件导入所需的最小替身模块"""
+import logging
+import os
+import sys
+import types
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def _install_astrbot_stub():
+    class _Filter:
+        class PermissionType:
+            ADMIN = "admin"
+
+        def command(self, name):
+            return lambda f: f
+
+        def permission_type(self, permission):
+            return lambda f: f
+
+    class MessageChain:
+        def __init__(self):
+            self.parts = []
+
+        def message(self, text):
+            self.parts.append(text)
+            return self
+
+    class Star:
+        def __init__(self, context):
+            self.context = context
+
+    modules = {
+        name: types.ModuleType(name) for name in (
+            "astrbot", "astrbot.api", "astrbot.api.event", "astrbot.api.star",
+            "astrbot.api.message_components", "astrbot.core", "astrbot.core.config",
+            "astrbot.core.config.astrbot_config", "astrbot.core.utils",
+            "astrbot.core.utils.session_waiter",
+        )
+    }
+    modules["astrbot.api"].logger = logging.getLogger("astrbot")
+    event = modules["astrbot.api.event"]
+    event.filter = _Filter()
+    event.AstrMessageEvent = type("AstrMessageEvent", (), {})
+    event.MessageEventResult = type("MessageEventResult", (), {})
+    event.MessageChain = MessageChain
+    star = modules["astrbot.api.star"]
+    star.Context = type("Context", (), {})
+    star.Star = Star
+    star.register = lambda *args, **kwargs: (lambda cls: cls)
+    modules["astrbot.core.config.astrbot_config"].AstrBotConfig = dict
+    waiter = modules["astrbot.core.utils.session_waiter"]
+    waiter.session_waiter = lambda timeout=0: (lambda f: f)
+    waiter.SessionController = type("SessionController", (), {})
+    sys.modules.update(modules)
+
+
+try:
+    import astrbot.api  # noqa: F401
+except ImportError:
+    _install_astrbot_stub()
@@ -0,0 +1,202 @@
+"""相同问题的并发提问共享同一个 GithubBot 查询"""
+import asyncio
+
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+import main
+
+
+class FakeGithubBot:
+    """模拟 GithubBot 的查询接口，release() 之前查询一直处于 processing 状态"""
+
+    def __init__(self):
+        self.submitted = []
+        self.cancelled = []
+        self.released = asyncio.Event()
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post("/api/v1/repos/query", self.submit)
+        app.router.add_get("/api/v1/repos/query/status/{sid}", self.status)
+        app.router.add_get("/api/v1/repos/query/result/{sid}", self.result)
+        app.router.add_post("/api/v1/repos/query/cancel/{sid}", self.cancel)
+        return app
+
+    def release(self):
+        self.released.set()
+
+    async def submit(self, request):
+        payload = await request.json()
+        self.submitted.append(payload["question"])
+        return web.json_response({"session_id": f"q{len(self.submitted)}"})
+
+    async def status(self, request):
+        return web.json_response({"status": "success" if self.released.is_set() else "processing"})
+
+    async def result(self, request):
+        index = int(request.match_info["sid"][1:]) - 1
+        return web.json_response({
+            "generation_mode": "service",
+            "answer": f"answer to {self.submitted[index]}",
+        })
+
+    async def cancel(self, request):
+        self.cancelled.append(request.match_info["sid"])
+        return web.json_response({"ok": True})
+
+
+class FakeContext:
+    """没有 LLM 提供商，问题都以 service 模式提交给 GithubBot"""
+
+    def get_using_provider(self):
+        return None
+
+
+def run_with_plugin(scenario):
+    """启动模拟 GithubBot 和插件实例，运行 scenario(plugin, bot) 后清理"""
+    async def runner():
+        bot = FakeGithubBot()
+        server = TestServer(bot.app())
+        await server.start_server()
+        plugin = main.Main(FakeContext(), {
+            "api_base_url": str(server.make_url("")).rstrip("/"),
+            "poll_interval": 0.02,
+            "local_index_enabled": False,
+        })
+        try:
+            await scenario(plugin, bot)
+        finally:
+            await plugin.terminate()
+            await server.close()
+    asyncio.run(runner())
+
+
+async def wait_until(condition, timeout: float = 5.0):
+    deadline = asyncio.get_running_loop().time() + timeout
+    while not condition():
+        assert asyncio.get_running_loop().time() < deadline, "等待条件超时"
+        await asyncio.sleep(0.01)
+
+
+def ask(plugin, user_id: str, question: str) -> asyncio.Task:
+    return asyncio.create_task(
+        plugin._ask_shared_question(user_id, "a1", question, main.Deadline(10))
+    )
+
+
+def test_concurrent_variants_share_one_query(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario(plugin, bot):
+        first = ask(plugin, "u1", "How do I install it?")
+        await wait_until(lambda: bot.submitted)
+        others = [
+            ask(plugin, "u2", "  how do I   install it? "),
+            ask(plugin, "u3", "HOW DO I INSTALL IT?"),
+        ]
+        await wait_until(lambda: len(plugin.job_tracker.active("u3")) == 1)
+        bot.release()
+
+        results = await asyncio.gather(first, *others)
+
+        assert bot.submitted == ["How do I install it?"]
+        assert [answer for answer, _, _ in results] == ["answer to How do I install it?"] * 3
+        assert [joined for _, _, joined in results] == [False, True, True]
+        assert plugin.metrics.counters["query.shared"] == 2
+        assert plugin._shared_queries == {}
+
+    run_with_plugin(scenario)
+
+
+def test_one_asker_leaving_does_not_stop_the_others(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario(plugin, bot):
+        first = ask(plugin, "u1", "What does it do?")
+        await wait_until(lambda: bot.submitted)
+        second = ask(plugin, "u2", "what does it do?")
+        await wait_until(lambda: plugin.job_tracker.active("u2"))
+
+        await plugin.job_tracker.cancel_user("u1", "exit")
+        bot.release()
+
+        with pytest.raises(main.JobCancelled):
+            await first
+        answer, outcome, joined = await second
+        assert (answer, outcome, joined) == ("answer to What does it do?", "success", True)
+        assert bot.cancelled == []
+
+    run_with_plugin(scenario)
+
+
+def test_last_asker_leaving_cancels_the_backend_query(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario(plugin, bot):
+        askers = [ask(plugin, "u1", "What does it do?")]
+        await wait_until(lambda: bot.submitted)
+        askers.append(ask(plugin, "u2", "What does it do? "))
+        await wait_until(lambda: plugin.job_tracker.active("u2"))
+
+        await plugin.job_tracker.cancel_user("u1", "exit")
+        assert bot.cancelled == []
+        await plugin.job_tracker.cancel_user("u2", "switch")
+
+        for asker in askers:
+            with pytest.raises(main.JobCancelled):
+                await asker
+        await wait_until(lambda: not plugin._shared_queries)
+        assert bot.cancelled == ["q1"]
+        assert bot.submitted == ["What does it do?"]
+
+    run_with_plugin(scenario)
+
+
+def test_asker_joins_in_flight_prefetch(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario(plugin, bot):
+        plugin.prefetch_questions = ["What does it do?"]
+        prefetch = plugin.job_tracker.start(
+            "u1", "prefetch", plugin._prefetch_common_questions("u1", "https://github.com/o/r", "a1")
+        )
+        await wait_until(lambda: bot.submitted)
+        asker = ask(plugin, "u2", "what does it do?")
+        await wait_until(lambda: plugin.job_tracker.active("u2"))
+        bot.release()
+
+        answer, _, joined = await asker
+        await prefetch.wait()
+        assert (answer, joined) == ("answer to What does it do?", True)
+        assert bot.submitted == ["What does it do?"]
+
+    run_with_plugin(scenario)
+
+
+def test_joining_short_prefetch_keeps_the_askers_budget(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+
+    async def scenario(plugin, bot):
+        plugin.prefetch_questions = ["What does it do?"]
+        plugin.prefetch_budget_seconds = 0.5
+        prefetch = plugin.job_tracker.start(
+            "u1", "prefetch", plugin._prefetch_common_questions("u1", "https://github.com/o/r", "a1")
+        )
+        await wait_until(lambda: bot.submitted)
+        asker = ask(plugin, "u2", "what does it do?")
+        await wait_until(lambda: plugin.job_tracker.active("u2"))
+
+        # 预取在自己的预算用尽后放弃等待，共享查询按提问者的预算继续
+        await prefetch.wait()
+        assert plugin.metrics.counters["prefetch.budget_exhausted"] == 1
+        await asyncio.sleep(0.3)
+        assert bot.cancelled == []
+        bot.release()
+
+        answer, outcome, joined = await asker
+        assert (answer, outcome, joined) == ("answer to What does it do?", "success", True)
+        assert bot.submitted == ["What does it do?"]
+
+    run_with_plugin(scenario)